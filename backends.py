@@ -0,0 +1,464 @@
+import importlib.util
+import json
+import multiprocessing
+import os
+import threading
+from collections import Counter
+from time import time
+
+import numpy as np
+
+# Points resolved by each method of the escape-time kernels since the last reset,
+# and under iterations the iterations they ran, up to and including the escaping one
+kernel_stats = Counter()
+
+# Registered backends by name, instances are created on first use so heavy
+# libraries (torch, numba) are only imported when they are selected
+backends = {}
+_instances = {}
+active = None
+
+cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'fractals')
+
+# Kernel work buffers, per thread so a background render never shares them
+_workspaces = threading.local()
+
+
+def register(cls):
+    backends[cls.name] = cls
+    return cls
+
+
+def available():
+    return [name for name, cls in backends.items() if cls.available()]
+
+
+def get_backend(name=None):
+    # None picks the FRACTAL_BACKEND variable, then the last calibration, then calibrates
+    if name is None:
+        name = os.environ.get('FRACTAL_BACKEND') or _calibrated()
+    if name is None or name == 'auto':
+        name = calibrate()
+    if name not in backends:
+        raise ValueError('Unknown backend {}, options are {}'.format(name, list(backends)))
+    if name not in _instances:
+        if not backends[name].available():
+            raise ImportError('Backend {} is not installed'.format(name))
+        _instances[name] = backends[name]()
+    return _instances[name]
+
+
+def use(name=None):
+    # Select the backend the kernels run on when they get a plain array
+    global active
+    active = name if isinstance(name, Backend) else get_backend(name)
+    return active
+
+
+def backend_for(a):
+    if active is not None and active.accepts(a):
+        return active
+    for name in available():
+        b = get_backend(name)
+        if b.accepts(a):
+            return b
+    raise TypeError('No backend for {}'.format(type(a)))
+
+
+def process_context():
+    # multiprocessing context for worker processes. They are not forked from this
+    # process: threads started by the kernels (numba, torch) do not survive a fork,
+    # and the forkserver also starts them with a small memory high water mark
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def _calibrated():
+    try:
+        with open(os.path.join(cache_dir, 'backend.json')) as f:
+            name = json.load(f)['backend']
+    except (OSError, ValueError, KeyError):
+        return None
+    return name if name in backends and backends[name].available() else None
+
+
+def calibrate(resolution=(160, 128), nrep=200, verbose=False):
+    # Time every installed backend on a small view of the Mandelbrot set, keep the
+    # fastest one and remember it so later runs skip the benchmark
+    X = np.linspace(-2.1, .9, resolution[0])
+    Y = np.linspace(-1.2, 1.2, resolution[1])
+    c = (X[None, :]+1j*Y[:, None]).astype(np.complex128)
+    timings = {}
+    for name in available():
+        b = get_backend(name)
+        points = b.asarray(c)
+        b.mandelbrot(points[:2, :2], nrep)  # Warm up, JIT compilation
+        start = time()
+        b.mandelbrot(points, nrep)  # The dense kernel Fractal.gen runs
+        timings[name] = time()-start
+        if verbose:
+            print('{}: {:0.4f}s'.format(name, timings[name]))
+    kernel_stats.clear()
+    best = min(timings, key=timings.get)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(os.path.join(cache_dir, 'backend.json'), 'w') as f:
+            json.dump({'backend': best, 'timings': timings}, f)
+    except OSError:
+        pass
+    return best
+
+
+class Backend(object):
+    # Array library the C plane lives in and the escape-time kernels run on.
+    # Every backend iterates the real and imaginary parts separately in float64
+    # with the same operation order, so they all give the same counts
+    name = None
+    module = None
+
+    @classmethod
+    def available(cls):
+        return importlib.util.find_spec(cls.module) is not None
+
+    def __repr__(self):
+        return self.name
+
+    def accepts(self, a):
+        return isinstance(a, np.ndarray)
+
+    def asarray(self, a):
+        return a
+
+    def zeros(self, c):
+        return np.zeros_like(c)
+
+    def empty(self, shape, dtype=np.complex128):
+        return np.empty(shape, dtype=dtype)
+
+    def full(self, shape, value, dtype):
+        return np.full(shape, value, dtype=dtype)
+
+    def workspace(self, shape, dtype, count):
+        # count buffers of this shape and dtype name kept between calls, allocated
+        # flat and only grown when a larger chunk comes in, so renders reuse them
+        # chunk after chunk
+        size = int(np.prod(shape))
+        pool = getattr(_workspaces, 'pool', None)
+        if pool is None:
+            pool = _workspaces.pool = {}
+        key = (self.name, dtype)
+        buffers = pool.get(key, [])
+        if len(buffers) < count or buffers[0].shape[0] < size:
+            size_ = max(size, buffers[0].shape[0] if buffers else 0)
+            buffers = pool[key] = [self.empty(size_, key[1]) for _ in range(max(count, len(buffers)))]
+        return [b[:size].reshape(shape) for b in buffers[:count]]
+
+    def tile(self, X, Y, lo, hi, row_wise, out=None):
+        # Rows lo:hi of the C plane, or columns lo:hi laid out one column per row
+        if row_wise:
+            return np.add(X[None, :], Y[lo:hi, None], out=out)
+        return np.add(X[lo:hi, None], Y[None, :], out=out)
+
+    def numpy(self, a):
+        return a
+
+    def single_thread(self):
+        pass
+
+    def interior(self, c):
+        # Points inside the main cardioid or the period-2 bulb, both never escape
+        x = c.real
+        y2 = c.imag**2
+        q = (x-.25)**2+y2
+        cardioid = q*(q+(x-.25)) < .25*y2
+        bulb = (x+1)**2+y2 < .0625
+        return cardioid, bulb
+
+    def mandelbrot(self, c, nrep, compact=False, interior_check=False):
+        if not interior_check:
+            return self.escape_time(self.zeros(c), c, nrep, compact)
+
+        cardioid, bulb = self.interior(c)
+        kernel_stats['cardioid'] += int(cardioid.sum())
+        bulb &= ~cardioid
+        kernel_stats['bulb'] += int(bulb.sum())
+        outside = ~(cardioid | bulb)
+        M = self.full(c.shape, nrep, np.int16)
+        rest = c[outside]
+        M[outside] = self.asarray(self.numpy(self.escape_time(self.zeros(rest), rest, nrep, periodic=True)))
+        return M
+
+    def escape_time(self, z, c, nrep, compact=False, periodic=False):
+        raise NotImplementedError
+
+
+@register
+class NumpyBackend(Backend):
+    name = 'numpy'
+    module = 'numpy'
+
+    def escape_time(self, z, c, nrep, compact=False, periodic=False):
+        # Number of iterations z -> z**2+c stays inside |z| < 2, for every point of z
+        cr, ci = split(c)
+        if compact or periodic:
+            return self._compact(z.real.copy(), z.imag.copy(), cr, ci, nrep, periodic)
+        # Updated in place in the workspace, the squares taken for the |z|**2 < 4
+        # test are the ones the next step needs. 2*zr is taken before the product
+        # so the rounding is the same as 2*zr*zi
+        zr, zi, rr, ii, t = self.workspace(z.shape, z.real.dtype.name, 5)
+        inside, = self.workspace(z.shape, 'bool', 1)
+        zr[:], zi[:] = z.real, z.imag
+        np.multiply(zr, zr, out=rr)
+        np.multiply(zi, zi, out=ii)
+        M = np.zeros(z.shape, dtype=np.int16)
+        with np.errstate(over='ignore', invalid='ignore'):  # Escaped points overflow
+            for _ in range(nrep):
+                np.multiply(zr, 2, out=t)
+                np.multiply(t, zi, out=zi)
+                zi += ci
+                np.subtract(rr, ii, out=zr)
+                zr += cr
+                np.multiply(zr, zr, out=rr)
+                np.multiply(zi, zi, out=ii)
+                np.add(rr, ii, out=t)
+                np.less(t, 4, out=inside)
+                if not inside.any():
+                    break
+                M += inside
+        count_escaped(M, nrep)
+        return M
+
+    def _compact(self, zr, zi, cr, ci, nrep, periodic):
+        # Only the points still bounded are iterated, escaped ones are dropped from the
+        # active set and their count is scattered back into M, so the cost follows the
+        # total number of iterations actually executed instead of points x nrep
+        shape = zr.shape
+        zr, zi = zr.reshape(-1), zi.reshape(-1)
+        per_point = np.ndim(cr) > 0
+        if per_point:
+            cr, ci = cr.reshape(-1), ci.reshape(-1)
+        M = np.full(zr.shape, nrep, dtype=np.int16)
+        idx = np.arange(zr.shape[0])
+        ref = None
+        for n in range(nrep):
+            if not idx.shape[0]:
+                break
+            kernel_stats['iterations'] += idx.shape[0]
+            zr, zi = zr*zr-zi*zi+cr, 2*zr*zi+ci
+            out = zr*zr+zi*zi >= 4
+            if periodic and ref is not None:
+                # Brent cycle detection: an orbit that comes back exactly to the saved z
+                # is periodic in floating point and will never escape, so it keeps nrep
+                cycle = (zr == ref[0]) & (zi == ref[1])
+                kernel_stats['periodic'] += int(cycle.sum())
+                drop = out | cycle
+            else:
+                drop = out
+            if drop.any():
+                M[idx[out]] = n
+                kernel_stats['escaped'] += int(out.sum())
+                keep = ~drop
+                idx, zr, zi = idx[keep], zr[keep], zi[keep]
+                if per_point:
+                    cr, ci = cr[keep], ci[keep]
+                if ref is not None:
+                    ref = ref[0][keep], ref[1][keep]
+            if periodic and not (n+1) & n:
+                # Move the reference point forward at every power of two
+                ref = zr, zi
+        kernel_stats['max_iter'] += idx.shape[0]
+        return M.reshape(shape)
+
+
+@register
+class TorchBackend(Backend):
+    name = 'torch'
+    module = 'torch'
+
+    def __init__(self):
+        import torch
+        self.torch = torch
+        self.ctx = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+
+    def __repr__(self):
+        if self.ctx.type == 'cuda':
+            return 'torch on %s' % self.torch.cuda.get_device_name(0)
+        return 'torch on cpu'
+
+    def accepts(self, a):
+        return isinstance(a, self.torch.Tensor)
+
+    def asarray(self, a):
+        return self.torch.from_numpy(a).to(self.ctx)
+
+    def zeros(self, c):
+        return self.torch.zeros_like(c)
+
+    def empty(self, shape, dtype=np.complex128):
+        return self.torch.empty(shape, dtype=getattr(self.torch, np.dtype(dtype).name), device=self.ctx)
+
+    def full(self, shape, value, dtype):
+        return self.torch.full(shape, value, dtype=getattr(self.torch, np.dtype(dtype).name), device=self.ctx)
+
+    def tile(self, X, Y, lo, hi, row_wise, out=None):
+        if row_wise:
+            return self.torch.add(X[None, :], Y[lo:hi, None], out=out)
+        return self.torch.add(X[lo:hi, None], Y[None, :], out=out)
+
+    def numpy(self, a):
+        return a.cpu().numpy()
+
+    def single_thread(self):
+        self.torch.set_num_threads(1)
+
+    def escape_time(self, z, c, nrep, compact=False, periodic=False):
+        torch = self.torch
+        cr, ci = split(c)
+        if compact or periodic:
+            M = self._compact(z.real.clone(), z.imag.clone(), cr, ci, nrep, periodic)
+        else:
+            # Same in place steps as NumpyBackend.escape_time
+            zr, zi, rr, ii, t = self.workspace(z.shape, str(z.real.dtype).split('.')[-1], 5)
+            inside, = self.workspace(z.shape, 'bool', 1)
+            zr.copy_(z.real)
+            zi.copy_(z.imag)
+            torch.mul(zr, zr, out=rr)
+            torch.mul(zi, zi, out=ii)
+            M = torch.zeros(z.shape, dtype=torch.int16, device=self.ctx)
+            for _ in range(nrep):
+                torch.mul(zr, 2, out=t)
+                torch.mul(t, zi, out=zi)
+                zi += ci
+                torch.sub(rr, ii, out=zr)
+                zr += cr
+                torch.mul(zr, zr, out=rr)
+                torch.mul(zi, zi, out=ii)
+                torch.add(rr, ii, out=t)
+                torch.lt(t, 4, out=inside)
+                if not inside.any():
+                    break
+                M += inside
+            count_escaped(M, nrep)
+
+        if self.ctx.type == 'cuda':
+            return M.cpu()
+        else:
+            return M
+
+    def _compact(self, zr, zi, cr, ci, nrep, periodic):
+        torch = self.torch
+        shape = zr.shape
+        zr, zi = zr.reshape(-1), zi.reshape(-1)
+        per_point = torch.is_tensor(cr) and cr.dim() > 0
+        if per_point:
+            cr, ci = cr.reshape(-1), ci.reshape(-1)
+        M = torch.full(zr.shape, nrep, dtype=torch.int16, device=self.ctx)
+        idx = torch.arange(zr.shape[0], device=self.ctx)
+        ref = None
+        for n in range(nrep):
+            if not idx.shape[0]:
+                break
+            kernel_stats['iterations'] += idx.shape[0]
+            zr, zi = zr*zr-zi*zi+cr, 2*zr*zi+ci
+            out = zr*zr+zi*zi >= 4
+            if periodic and ref is not None:
+                cycle = (zr == ref[0]) & (zi == ref[1])
+                kernel_stats['periodic'] += int(cycle.sum())
+                drop = out | cycle
+            else:
+                drop = out
+            if drop.any():
+                M[idx[out]] = n
+                kernel_stats['escaped'] += int(out.sum())
+                keep = ~drop
+                idx, zr, zi = idx[keep], zr[keep], zi[keep]
+                if per_point:
+                    cr, ci = cr[keep], ci[keep]
+                if ref is not None:
+                    ref = ref[0][keep], ref[1][keep]
+            if periodic and not (n+1) & n:
+                ref = zr, zi
+        kernel_stats['max_iter'] += idx.shape[0]
+        return M.reshape(shape)
+
+
+@register
+class NumbaBackend(Backend):
+    # One JIT compiled loop per pixel, each pixel stops as soon as it escapes
+    name = 'numba'
+    module = 'numba'
+
+    def __init__(self):
+        import numba
+        # TBB hangs at interpreter exit once a kernel ran outside the main thread
+        # (Explorer renders in background), prefer OpenMP unless a layer was chosen
+        if 'NUMBA_THREADING_LAYER' not in os.environ:
+            numba.config.THREADING_LAYER_PRIORITY = ['omp', 'tbb', 'workqueue']
+        self.numba = numba
+        self.loop = _compile_numba(numba)
+
+    def single_thread(self):
+        self.numba.set_num_threads(1)
+
+    def escape_time(self, z, c, nrep, compact=False, periodic=False):
+        zr, zi = np.ascontiguousarray(z.real).reshape(-1), np.ascontiguousarray(z.imag).reshape(-1)
+        cr, ci = split(c)
+        if np.ndim(cr) > 0:
+            cr, ci = np.ascontiguousarray(cr).reshape(-1), np.ascontiguousarray(ci).reshape(-1)
+        else:
+            cr, ci = np.full(zr.shape, cr), np.full(zr.shape, ci)
+        M = np.empty(zr.shape, dtype=np.int16)
+        how = np.empty(zr.shape, dtype=np.int8)
+        kernel_stats['iterations'] += int(self.loop(zr, zi, cr, ci, nrep, periodic, M, how))
+        resolved = np.bincount(how, minlength=3)
+        kernel_stats['escaped'] += int(resolved[0])
+        kernel_stats['max_iter'] += int(resolved[1])
+        if periodic:
+            kernel_stats['periodic'] += int(resolved[2])
+        return M.reshape(z.shape)
+
+
+def _compile_numba(numba):
+    @numba.njit(parallel=True, cache=True)
+    def loop(zr, zi, cr, ci, nrep, periodic, M, how):
+        # how: 0 escaped, 1 reached nrep, 2 periodic orbit. Returns the iterations run
+        total = 0
+        for i in numba.prange(zr.shape[0]):
+            x, y = zr[i], zi[i]
+            a, b = cr[i], ci[i]
+            rx, ry = np.nan, np.nan
+            M[i] = nrep
+            how[i] = 1
+            steps = nrep
+            for n in range(nrep):
+                x, y = x*x-y*y+a, 2*x*y+b
+                if x*x+y*y >= 4:
+                    M[i] = n
+                    how[i] = 0
+                    steps = n+1
+                    break
+                if periodic:
+                    if x == rx and y == ry:
+                        how[i] = 2
+                        steps = n+1
+                        break
+                    if not (n+1) & n:
+                        rx, ry = x, y
+            total += steps
+        return total
+    return loop
+
+
+def split(c):
+    # Real and imaginary parts of c, plain floats when c is a single value
+    if np.ndim(c) == 0:
+        c = complex(c)
+    return c.real, c.imag
+
+
+def count_escaped(M, nrep):
+    # For kernels that only stop at an escape: a count n took n+1 iterations
+    escaped = int((M < nrep).sum())
+    kernel_stats['escaped'] += escaped
+    kernel_stats['max_iter'] += int(np.prod(M.shape))-escaped
+    kernel_stats['iterations'] += int(M.sum())+escaped
@@ -0,0 +1,128 @@
+from core import Server, fractal, julia, mandelbrot
+import backends
+import argparse
+import csv
+import json
+import os
+from time import time
+
+# Manifest columns, a JSON manifest is a list of objects with the same keys.
+# Only name, px, py and scale are required. px and py are best given as strings in
+# JSON, deep views need more digits than a float holds. type is mandelbrot, julia
+# or a formula name (burning_ship, tricorn, multibrot<d>)
+defaults = {'nrep': 200, 'type': 'mandelbrot', 'c': None, 'width': 1000, 'height': 1000, 'chunk_size': 100,
+            'format': 'npz'}
+extensions = {'npz': '.npz', 'png': '.png', 'jpg': '.jpg', 'tiles': '.tiles'}
+
+
+def read_manifest(path):
+    if path.endswith('.csv'):
+        with open(path, newline='') as f:
+            rows = [{k: v for k, v in row.items() if v not in ('', None)} for row in csv.DictReader(f)]
+    else:
+        with open(path) as f:
+            rows = json.load(f)
+    jobs = []
+    for row in rows:
+        job = dict(defaults, **row)
+        # The point is kept as text, only checked to be a number
+        job['px'], job['py'], job['scale'] = str(job['px']).strip(), str(job['py']).strip(), float(job['scale'])
+        float(job['px']), float(job['py'])
+        job['nrep'] = job['nrep'] if job['nrep'] == 'auto' else int(job['nrep'])
+        job['width'], job['height'], job['chunk_size'] = int(job['width']), int(job['height']), int(job['chunk_size'])
+        if job['format'] not in extensions:
+            raise ValueError('{}: unknown format {}, use one of {}'.format(job['name'], job['format'],
+                                                                           ', '.join(extensions)))
+        jobs.append(job)
+    return jobs
+
+
+def output(job, out_dir):
+    return os.path.join(out_dir, job['name']+extensions[job['format']])
+
+
+# Servers of a worker process by resolution, jobs of the same resolution share
+# one, with its M, its chunk buffer and its selected backend
+_servers = {}
+
+
+def get_server(resolution, backend, single_thread):
+    if resolution not in _servers:
+        server = Server(list(resolution), [0., 0.])
+        server.select(backend)
+        if single_thread:
+            server.backend.single_thread()
+        _servers[resolution] = server
+    return _servers[resolution]
+
+
+def run_job(job, out_dir, backend=None, single_thread=False):
+    # Render one job, the summary entry is returned instead of raising
+    path = output(job, out_dir)
+    entry = {'name': job['name'], 'output': path}
+    if os.path.exists(path):
+        return dict(entry, status='skipped')
+    start = time()
+    try:
+        frac = get_server((job['width'], job['height']), backend, single_thread)
+        frac.change([job['px'], job['py']], job['scale'], job['nrep'])
+        if job['type'] == 'julia':
+            frac_type = julia(complex(job['c'].replace(' ', '') if isinstance(job['c'], str) else job['c']))
+        elif job['type'] == 'mandelbrot':
+            frac_type = mandelbrot
+        else:
+            frac_type = fractal(job['type'])
+        frac.gen(frac_type, job['chunk_size'])
+        render = time()-start
+        # Written under a temporary name and renamed once complete, an interrupted
+        # job leaves no output that a rerun would skip
+        part = os.path.join(out_dir, '.'+job['name']+'.part')
+        if job['format'] == 'npz':
+            frac.export(part)
+        elif job['format'] == 'tiles':
+            frac.export(part+'.tiles', chunked=True)
+        else:
+            frac.save(part, job['format'])
+        os.replace(part+extensions[job['format']], path)
+    except Exception as e:
+        return dict(entry, status='failed', error=repr(e), seconds=time()-start)
+    return dict(entry, status='done', nrep=frac.nrep, render=render, seconds=time()-start)
+
+
+def _run(args):
+    return run_job(*args)
+
+
+def run(jobs, out_dir, workers=1, backend=None):
+    # Jobs are sorted by resolution so the jobs a worker takes in a row mostly
+    # reuse its Server. Worker processes render on one thread each
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = sorted(jobs, key=lambda job: (job['width'], job['height']))
+    if workers <= 1:
+        return [run_job(job, out_dir, backend) for job in jobs]
+    # Leaving the with block terminates the workers, also on an interrupt
+    with backends.process_context().Pool(workers) as pool:
+        summary = list(pool.imap_unordered(_run, [(job, out_dir, backend, True) for job in jobs],
+                                           chunksize=max(1, len(jobs)//(4*workers))))
+        pool.close()
+        pool.join()
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Batch fractal renders')
+    parser.add_argument('manifest', type=str, help='JSON or CSV list of jobs')
+    parser.add_argument('--out', type=str, default='renders', help='Output directory')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes')
+    parser.add_argument('--backend', type=str, default=None, help='Kernel backend, calibrated when not given')
+    parser.add_argument('--summary', type=str, default=None, help='Summary file, <out>/summary.json by default')
+    args = parser.parse_args()
+
+    start = time()
+    backends.get_backend(args.backend)  # Calibrate once before the workers start
+    summary = run(read_manifest(args.manifest), args.out, args.workers, args.backend)
+    counts = {s: sum(e['status'] == s for e in summary) for s in ('done', 'skipped', 'failed')}
+    with open(args.summary or os.path.join(args.out, 'summary.json'), 'w') as f:
+        json.dump({'total': time()-start, 'counts': counts, 'jobs': summary}, f, indent=1)
+    print('{done} done, {skipped} skipped, {failed} failed'.format(**counts),
+          'in {:0.1f}s'.format(time()-start))
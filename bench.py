@@ -0,0 +1,134 @@
+from core import Server, mandelbrot
+import backends
+import numpy as np
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+from time import time
+
+# Reference views as (point, scale, nrep). All but interior sit on the boundary so
+# the counts spread out, the deep one below deep_scale to time the perturbation engine
+views = {'shallow': ([-0.75, 0.], 1.2, 200),
+         'boundary': ([-0.7436438870371587, 0.1318259042053119], 1e-4, 2000),
+         'interior': ([-0.2, 0.], 0.3, 1000),
+         'deep': (['-0.743643887037158704752191506114774', '0.131825904205311970493132056385139'], 5e-14, 8000)}
+# Fewest distinct counts a boundary view may render with, a flat one only times a
+# single loop. interior is flat on purpose, it times the interior check
+min_spread = 64
+chunk_sizes = [8, 32, 128, 512]
+resolutions = [256, 512, 1024]
+
+
+def peak_rss():
+    # Peak resident memory of the process so far in MB, ru_maxrss is in kB on Linux.
+    # Every workload runs in a process of its own, so this is the peak of that one
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/2**20 if sys.platform == 'darwin' else rss/2**10
+
+
+def isolated(func, *args):
+    # func(*args) in a new process, see backends.process_context
+    with backends.process_context().Pool(1, maxtasksperchild=1) as pool:
+        return pool.apply(func, args)
+
+
+def timed(func, repeat):
+    # Best of repeat runs, after one untimed run that compiles and warms the caches
+    func()
+    best = float('inf')
+    for _ in range(repeat):
+        start = time()
+        func()
+        best = min(best, time()-start)
+    return best
+
+
+def render(name, view, size, chunk_size, repeat, backend, spread=min_spread):
+    point, scale, nrep = view
+    frac = Server([size, size], list(point), scale, nrep)
+    frac.change(list(point), scale, nrep)
+    frac.select(backend)
+    seconds = timed(lambda: frac.gen(mandelbrot, chunk_size), repeat)
+    counts = len(np.unique(frac.M))
+    if counts < spread:
+        raise ValueError('View {} renders only {} distinct counts, pick a point on the boundary'.format(name, counts))
+    # Iterations the kernels ran in the last render, see backends.kernel_stats
+    iterations = frac.stats.get('iterations', 0)
+    return {'name': name, 'seconds': seconds, 'points_per_s': frac.M.size/seconds,
+            'iterations_per_s': iterations/seconds, 'peak_rss_mb': peak_rss()}
+
+
+def colorize(size, fmt, repeat, backend):
+    point, scale, nrep = views['shallow']
+    frac = Server([size, size], list(point), scale, nrep)
+    frac.change(list(point), scale, nrep)
+    frac.gen(mandelbrot, 128, backend=backend)
+    with tempfile.TemporaryDirectory() as tmp:
+        seconds = timed(lambda: frac.save(os.path.join(tmp, 'bench'), fmt), repeat)
+    return {'name': 'save/{}/{}'.format(fmt, size), 'seconds': seconds, 'points_per_s': frac.M.size/seconds,
+            'peak_rss_mb': peak_rss()}
+
+
+def run(size=512, repeat=3, backend=None, only=None):
+    workloads = []
+    if only in (None, 'views'):
+        for name, view in views.items():
+            workloads.append((render, 'view/'+name, view, size, 64, repeat, backend,
+                              1 if name == 'interior' else min_spread))
+    if only in (None, 'chunks'):
+        for chunk_size in chunk_sizes:
+            workloads.append((render, 'chunk/{}'.format(chunk_size), views['boundary'], size, chunk_size, repeat,
+                              backend))
+    if only in (None, 'resolution'):
+        for r in resolutions:
+            workloads.append((render, 'resolution/{}'.format(r), views['shallow'], r, 64, repeat, backend))
+    if only in (None, 'save'):
+        for fmt in ('png', 'jpg'):
+            workloads.append((colorize, 2*size, fmt, repeat, backend))
+    return [isolated(*workload) for workload in workloads]
+
+
+def compare(results, baseline, tolerance):
+    # Throughput of every workload against the baseline, the names of the ones
+    # slower by more than tolerance are returned
+    old = {r['name']: r for r in baseline['results']}
+    slower = []
+    for r in results:
+        if r['name'] not in old:
+            continue
+        ratio = r['points_per_s']/old[r['name']]['points_per_s']
+        flag = ''
+        if ratio < 1-tolerance:
+            slower.append(r['name'])
+            flag = '  <-- slower'
+        print('{:<20} {:>12.0f} pts/s  {:>6.2f}x{}'.format(r['name'], r['points_per_s'], ratio, flag))
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Fractal benchmarks')
+    parser.add_argument('--size', type=int, default=512, help='Side of the rendered views in pixels')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per workload, the best is kept')
+    parser.add_argument('--backend', type=str, default=None, help='Kernel backend, calibrated when not given')
+    parser.add_argument('--only', type=str, default=None, choices=['views', 'chunks', 'resolution', 'save'])
+    parser.add_argument('--out', type=str, default=None, help='Write the results as JSON here')
+    parser.add_argument('--baseline', type=str, default=None, help='Results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=.1, help='Slowdown over the baseline that fails')
+    args = parser.parse_args()
+
+    bk = backends.get_backend(args.backend)
+    results = run(args.size, args.repeat, bk.name, args.only)
+    report = {'backend': bk.name, 'size': args.size, 'python': platform.python_version(),
+              'machine': platform.machine(), 'cpus': os.cpu_count(), 'results': results}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+        sys.exit(1 if slower else 0)
+    json.dump(report, sys.stdout, indent=1)
@@ -0,0 +1,107 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+class TileCache(object):
+    # Rendered tiles kept in memory up to budget bytes, least recently used first
+    # out. With spill set, evicted tiles are written to that directory and read
+    # back on demand instead of being lost
+    def __init__(self, budget=256*2**20, spill=None, tile=128):
+        self.budget = budget
+        self.spill = spill
+        self.tile = tile
+        self.tiles = OrderedDict()
+        self.spilled = set()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.spill_hits = 0
+        # Tiles rendered ahead of need while speculative is set, and how many of them
+        # a later render used
+        self.speculative = False
+        self.prefetched = set()
+        self.prefetch_hits = 0
+        if spill is not None:
+            os.makedirs(spill, exist_ok=True)
+
+    def __contains__(self, key):
+        return key in self.tiles or key in self.spilled
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def path(self, key):
+        return os.path.join(self.spill, hashlib.sha1(repr(key).encode()).hexdigest()+'.npy')
+
+    def get(self, key):
+        if key in self.prefetched and key in self and not self.speculative:
+            self.prefetched.discard(key)
+            self.prefetch_hits += 1
+        if key in self.tiles:
+            self.tiles.move_to_end(key)
+            self.hits += 1
+            return self.tiles[key]
+        if key in self.spilled:
+            self.spill_hits += 1
+            self.hits += 1
+            value = np.load(self.path(key))
+            self.put(key, value)
+            return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if key in self.tiles:
+            self.nbytes -= self.tiles.pop(key).nbytes
+        self.tiles[key] = value
+        self.nbytes += value.nbytes
+        if self.speculative:
+            self.prefetched.add(key)
+        while self.nbytes > self.budget and len(self.tiles) > 1:
+            old, tile = self.tiles.popitem(last=False)
+            self.nbytes -= tile.nbytes
+            if self.spill is not None and old not in self.spilled:
+                np.save(self.path(old), tile)
+                self.spilled.add(old)
+            elif self.spill is None:
+                self.prefetched.discard(old)
+
+    def clear(self):
+        self.tiles.clear()
+        self.nbytes = 0
+        for key in self.spilled:
+            os.remove(self.path(key))
+        self.spilled.clear()
+        self.prefetched.clear()
+
+    def hit_rate(self):
+        total = self.hits+self.misses
+        return self.hits/total if total else 0.
+
+    def report(self):
+        return {'hits': self.hits, 'misses': self.misses, 'spill_hits': self.spill_hits,
+                'prefetch_hits': self.prefetch_hits,
+                'hit_rate': self.hit_rate(), 'tiles': len(self.tiles), 'spilled': len(self.spilled),
+                'nbytes': self.nbytes}
+
+
+def kernel_key(frac_type, nrep):
+    # Identifies what a kernel computes: its name, arguments and the iteration cap
+    func = getattr(frac_type, 'func', frac_type)
+    args = tuple(_plain(a) for a in getattr(frac_type, 'args', ()))
+    keywords = tuple(sorted((k, _plain(v)) for k, v in getattr(frac_type, 'keywords', {}).items()))
+    return (func.__module__, func.__name__, args, keywords, nrep)
+
+
+def _plain(value):
+    # Hashable stand-in for a kernel argument, array scalars become complex numbers
+    try:
+        hash(value)
+    except TypeError:
+        return complex(value)
+    if np.ndim(value) == 0 and not isinstance(value, (str, bool, int, float, complex)):
+        return complex(value)
+    return value
@@ -5,6 +5,7 @@ from matplotlib.colors import LinearSegmentedColormap
 from matplotlib import cm
 import pyperclip
 import argparse
+from store import load
 
 # export LD_PRELOAD=/usr/lib/libstdc++.so.6
 
@@ -75,13 +76,10 @@ class Artist_GUI(object):
     col_anch = []
     nrows = int(0)
 
-    def __init__(self, name):
+    def __init__(self, name, size=2000):
         self.name = name
-        with np.load(name) as f:
-            if len(f.files) == 1:
-                self.M = f[f.files[0]]
-            else:
-                self.M = [f[m] for m in f.files]
+        # A chunked store is only read at the level that fits in size pixels
+        self.M = load(name, size)
         self.bplus.on_clicked(lambda event: self.add_button())
         self.bcmap.on_clicked(lambda event: self.gen_cm())
         self.bplot.on_clicked(lambda event: self.update_fr())
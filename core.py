@@ -1,96 +1,741 @@
-import torch
-ctx = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
+import json
 import os
+import threading
 
+from functools import partial
+from multiprocessing import shared_memory
 from time import time
 
+import backends
+import instrument
+from backends import backend_for, kernel_stats
+from cache import TileCache, kernel_key
+from deep import deep_scale, perturb, precision, reference_orbit, series
+from formula import formula_escape_time, multibrot_formula, parse_formula
+from image import colorize, write_jpeg, write_png
+from instrument import stage
+from store import Store
+
+class Cancelled(Exception):
+    # Raised inside a render when its cancel event is set
+    pass
+
+
 def hex2rgb(h):
     v = tuple(int(h[i:i + 2], 16) for i in (0, 2, 4))
     return tuple(c/256 for c in reversed(v))
 
 
 class Fractal(object):
-    def __init__(self, resolution, point, scale=1.875e-05, nrep=200, row_wise=True, debug=False):
+    def __init__(self, resolution, point, scale=1.875e-05, nrep=200, row_wise=True, debug=False, mmap=None):
         self.resolution = resolution
         self.point = point
         self.scale = scale
         self.wh = [1*self.scale, 1*self.scale]
-        self.nrep = nrep
+        # nrep='auto' picks the iteration cap of every render with auto_nrep
+        self.adaptive = nrep == 'auto'
+        self.nrep = 200 if self.adaptive else nrep
         self.row_wise = row_wise
         self.debug = debug
-        self.M = np.zeros(resolution, dtype=np.uint16)
-        if self.row_wise:
-            self.M = self.M.T
-
-        if debug and ctx.type == 'cuda':
-            print('Using %s' % torch.cuda.get_device_name(0))
-
+        self.stats = {}
+        self.backend = None
+        self.moved = (0, 0)
+        self.previous = None
+        self.cancel = None  # threading.Event checked between chunks
+        # C plane dtype: complex128, complex64 or 'auto' for complex64 when the pixel
+        # spacing is coarse enough. Random pixels are then also spot-checked at both
+        # and complex64 dropped when more than tolerance of them change count. The
+        # check takes validate pixels, at least the 10/tolerance that resolve it
+        self.dtype = np.complex128
+        self.validate = 0
+        self.tolerance = 1e-3
+        self.planes = {}
+        # With mmap M is a .npy file on disk, gen writes it tile by tile and records
+        # the finished tiles so an interrupted render restarts where it stopped
+        self.path = mmap
+        self.done = set()
+        self.pending = []
+        self.record_tiles = 256
+        self.record_seconds = 5.
+        # M is indexed [y, x] in both orientations
+        if mmap is not None:
+            self.M = open_mmap(mmap, (resolution[1], resolution[0]))
+            return
+        self.M = np.zeros(resolution, dtype=np.uint16).T
 
     def change(self, point, scale, nrep=None):
         self.point = point
         self.scale = scale
         if nrep is not None:
-            self.nrep = nrep
+            self.adaptive = nrep == 'auto'
+            if not self.adaptive:
+                self.nrep = nrep
         self.wh = [1.25 * self.scale, 1 * self.scale]
+        self.moved = (0, 0)
 
-    def get_row_column(self):
-        # Generate rows or columns of the C plane
-        x_lim = [self.point[0]-self.wh[0], self.point[0]+self.wh[0]]
-        y_lim = [self.point[1]+self.wh[1], self.point[1]-self.wh[1]]
+    def check(self):
+        if self.cancel is not None and self.cancel.is_set():
+            raise Cancelled()
 
-        X = torch.linspace(x_lim[0], x_lim[1], self.resolution[0], dtype=torch.complex128)
-        Y = torch.linspace(y_lim[1], y_lim[0], self.resolution[1], dtype=torch.complex128)*1j
-        if self.row_wise:
-            for y in Y:
-                yield X+y
-        else:
-            for x in X:
-                yield x+Y
+    def spacing(self):
+        # Distance between two pixels on each axis
+        return 2*self.wh[0]/(self.resolution[0]-1), 2*self.wh[1]/(self.resolution[1]-1)
+
+    def move(self, di, dj):
+        # Move the view by whole pixels, pixel (j, i) becomes the old (j+dj, i+di).
+        # gen_moved then only has to compute the pixels that came into view
+        dx, dy = self.spacing()
+        self.point[0] += di*dx
+        self.point[1] += dj*dy
+        self.moved = (self.moved[0]+di, self.moved[1]+dj)
 
-    def gen(self, frac_type, chunk_size=2):
-        cs = chunk_size
-        chunk = None  # Tensor Pointer
-        slices = []
+    def get_axes(self):
+        # Real and imaginary axes of the C plane
+        px, py = float(self.point[0]), float(self.point[1])
+        x_lim = [px-self.wh[0], px+self.wh[0]]
+        y_lim = [py+self.wh[1], py-self.wh[1]]
+
+        # Built with numpy for every backend so they all sample the same points
+        X = np.linspace(x_lim[0], x_lim[1], self.resolution[0]).astype(np.complex128)
+        Y = np.linspace(y_lim[1], y_lim[0], self.resolution[1])*1j
+        return X, Y
+
+    def select(self, backend=None):
+        # Backend by name, None uses the environment override or the calibrated choice
+        if backend is not None or self.backend is None:
+            self.backend = backends.get_backend(backend)
+            if self.debug:
+                print('Using %s' % self.backend)
+        backends.use(self.backend)
+        return self.backend
+
+    def gen(self, frac_type, chunk_size=2, workers=1, backend=None, deep=None, skip=False, cache=None,
+            subdivide=False):
+        # deep=None switches to the perturbation engine once the scale is too small
+        # for complex128, point can then be given as strings to keep all its digits.
+        # skip starts deep renders after the iterations the series approximation covers.
+        # subdivide renders by rectangles, see gen_subdivide, 'strict' for exact output.
+        # chunk_size='auto' uses the size tuned for this backend and resolution
+        if deep is None:
+            deep = deep_view(self.scale, frac_type)
+        # The cap is probed on the backend that renders, deep views probe with perturb
+        bk = None if deep else self.select(backend)
+        if self.adaptive:
+            self.auto_nrep(frac_type, backend=bk)
+        if chunk_size == 'auto':
+            chunk_size = self.tune_chunk(frac_type, backend)
+        if deep:
+            return self.gen_deep(frac_type, chunk_size, skip)
+        if cache is not None:
+            return self.gen_cached(frac_type, cache)
+        if subdivide:
+            return self.gen_subdivide(frac_type, strict=subdivide == 'strict')
+        if self.path is not None:
+            self.resume(frac_type, chunk_size)
+        if workers > 1:
+            return self.gen_parallel(frac_type, chunk_size, workers)
+        # Each chunk is built as one 2D block inside a buffer kept between renders,
+        # and the kernel output goes straight into the matching view of M
+        n = self.resolution[1] if self.row_wise else self.resolution[0]
+        dtype = self.plane_dtype(frac_type)
+        with stage('axes'):
+            X, Y = [bk.asarray(a.astype(dtype)) for a in self.get_axes()]
+        buf = self.tile_buffer(chunk_size, len(X) if self.row_wise else len(Y), dtype)
         start_exec = time()
-        chunk_time = np.array([])
-        for i, r in enumerate(self.get_row_column()):
-            if chunk is None:
-                chunk = r
-            else:
-                chunk = torch.cat((chunk, r))
-            slices.append(slice((cs-1)*len(r), cs*len(r)))
-            cs -= 1
-            if cs:
-                continue
-            in_points = chunk.to(ctx)  # Points to evaluate
-
-            # in_points = chunk.cuda(ctx) if ctx.type == 'cuda' else chunk
-            # Operations performed in GPU
-            start_chunk = time()
-            out_stream = frac_type(in_points, self.nrep)
-            if len(slices) > 1:
-                slices.reverse()
-                for j, s in zip(range((i+1)-chunk_size, i+1), slices):
-                    if self.row_wise:
-                        self.M[j] = out_stream [s]
-                    else:
-                        self.M[:, j] = out_stream[s]
-            else:
-                self.M[i] = out_stream
-            chunk_time = np.append(chunk_time, time()-start_chunk)
+        chunk_time = []
+        kernel_stats.clear()
+        try:
+            for lo in range(0, n, chunk_size):
+                if lo in self.done:
+                    continue
+                self.check()
+                hi = min(lo+chunk_size, n)
+                with stage('grid', lo=lo):
+                    in_points = bk.tile(X, Y, lo, hi, self.row_wise, out=buf[:hi-lo])
 
-            cs = chunk_size
-            slices = []
-            del in_points
-            del chunk
-            chunk = None
+                start_chunk = time()
+                with stage('kernel', lo=lo):
+                    values = frac_type(in_points, self.nrep)
+                with stage('copy', lo=lo):
+                    values = bk.numpy(values)
+                with stage('store', lo=lo):
+                    store_tile(self.M, lo, hi, self.row_wise, values)
+                chunk_time.append(time()-start_chunk)
+                instrument.count(points=values.size)
+                if self.path is not None:
+                    self.tile_done(lo)
+        finally:
+            # Tiles finished before a cancel or an error are kept too
+            if self.path is not None:
+                self.record()
 
+        self.stats = dict(kernel_stats)
+        instrument.count(**kernel_stats)
         if self.debug:
             print('Plane generation:{:0.3f}s'.format(time()-start_exec))
-            print('Average chunk execution:{:0.3f}s'.format(chunk_time.mean()))
+            if chunk_time:
+                print('Average chunk execution:{:0.3f}s'.format(np.mean(chunk_time)))
+            print('Resolved points:', ', '.join('{}={}'.format(k, v) for k, v in sorted(self.stats.items())))
+
+
+    def eval_block(self, frac_type, rows, cols, chunk_size=None):
+        # Evaluate the pixels M[rows, cols] in place, rows and cols are slices or
+        # index arrays
+        dtype = self.plane_dtype(frac_type)
+        X, Y = [a.astype(dtype) for a in self.get_axes()]
+        bk = self.backend
+        strided = isinstance(rows, slice) and isinstance(cols, slice)
+        X, Y = bk.asarray(X[cols]), bk.asarray(Y[rows])
+        M = self.M[rows, cols] if strided else None
+        chunk_size = chunk_size or len(Y)
+        for lo in range(0, len(Y), chunk_size):
+            self.check()
+            hi = min(lo+chunk_size, len(Y))
+            with stage('grid', lo=lo):
+                points = bk.tile(X, Y, lo, hi, True)
+            iterations = kernel_stats['iterations']
+            with stage('kernel', lo=lo):
+                values = frac_type(points, self.nrep)
+            with stage('copy', lo=lo):
+                values = bk.numpy(values)
+            instrument.count(points=values.size, iterations=kernel_stats['iterations']-iterations)
+            if strided:
+                M[lo:hi] = values
+            else:
+                self.M[np.ix_(rows[lo:hi], cols)] = values
+
+    def gen_reuse(self, frac_type, axes, chunk_size=2, backend=None):
+        # Render the view reusing the samples of the last frame, taken on the given
+        # axes, that land exactly on the new grid. After a 2x zoom in or out of an
+        # aligned grid that is one pixel out of four. Returns the pixels reused
+        self.select(backend)
+        start_exec = time()
+        kernel_stats.clear()
+        X, Y = self.get_axes()
+        ox, nx = coincident(axes[0].real, X.real)
+        oy, ny = coincident(axes[1].imag, Y.imag)
+        if not len(nx) or not len(ny):
+            return 0
+        self.M[np.ix_(ny, nx)] = self.M[np.ix_(oy, ox)]
+        rows = np.setdiff1d(np.arange(len(Y)), ny)
+        cols = np.setdiff1d(np.arange(len(X)), nx)
+        if len(rows):
+            self.eval_block(frac_type, rows, np.arange(len(X)), chunk_size)
+        if len(cols):
+            self.eval_block(frac_type, ny, cols, chunk_size)
+
+        self.stats = dict(kernel_stats)
+        if self.debug:
+            print('Reused {} pixels:{:0.3f}s'.format(len(nx)*len(ny), time()-start_exec))
+        return len(nx)*len(ny)
+
+    def gen_moved(self, frac_type, chunk_size=2, backend=None):
+        # Shift M in place by the pixels moved since the last render and compute only
+        # the exposed rows and columns
+        di, dj = self.moved
+        self.moved = (0, 0)
+        h, w = self.M.shape
+        if abs(di) >= w or abs(dj) >= h:
+            return self.gen(frac_type, chunk_size, backend=backend)
+        self.select(backend)
+        start_exec = time()
+        kernel_stats.clear()
+        self.M[max(-dj, 0):h-max(dj, 0), max(-di, 0):w-max(di, 0)] = \
+            self.M[max(dj, 0):h-max(-dj, 0), max(di, 0):w-max(-di, 0)]
+        rows = slice(h-dj, h) if dj > 0 else slice(0, -dj)
+        if dj:
+            self.eval_block(frac_type, rows, slice(0, w), chunk_size)
+        rest = slice(0, h-dj) if dj > 0 else slice(-dj, h)
+        if di:
+            self.eval_block(frac_type, rest, slice(w-di, w) if di > 0 else slice(0, -di), chunk_size)
+
+        self.stats = dict(kernel_stats)
+        if self.debug:
+            print('Moved ({}, {}) pixels:{:0.3f}s'.format(di, dj, time()-start_exec))
+
+    def gen_progressive(self, frac_type, chunk_size=2, backend=None, first=4):
+        # Coarse to fine rendering, the first pass samples one pixel out of first**2
+        # and every next pass halves the step computing only the pixels that are new
+        # on its grid, like the Adam7 interlacing. Yields the step of each finished pass
+        self.select(backend)
+        start_exec = time()
+        kernel_stats.clear()
+        s = first
+        blocks = [(slice(0, None, s), slice(0, None, s))]
+        while True:
+            for rows, cols in blocks:
+                self.eval_block(frac_type, rows, cols, chunk_size)
+            self.stats = dict(kernel_stats)
+            if self.debug:
+                print('Pass 1/{}:{:0.3f}s'.format(s, time()-start_exec))
+            yield s
+            if s == 1:
+                break
+            s //= 2
+            blocks = [(slice(0, None, 2*s), slice(s, None, 2*s)), (slice(s, None, 2*s), slice(0, None, s))]
+
+    def gen_subdivide(self, frac_type, backend=None, strict=False, min_size=6, batch=2**16):
+        # Mariani-Silver subdivision: compute only the border of a rectangle, fill the
+        # inside when the whole border has one count and split the rectangle in four
+        # otherwise, down to min_size where the inside is computed in full. Every
+        # level is evaluated as one batch of points. A uniform border of samples does
+        # not prove the inside uniform, a filament can cross it between two pixels, so
+        # strict never fills from borders: it only skips the pixels the cardioid and
+        # bulb tests prove interior and computes the rest, the output is then the
+        # same as gen
+        bk = self.select(backend)
+        start_exec = time()
+        kernel_stats.clear()
+        M = self.M
+        h, w = M.shape
+        known = np.zeros((h, w), dtype=bool)
+        filled = 0
+        if strict:
+            if kernel_name(frac_type) == 'mandelbrot':
+                X, Y = self.get_axes()
+                cardioid, bulb = backends.get_backend('numpy').interior(Y.reshape(-1, 1)+X.reshape(1, -1))
+                known = cardioid | bulb
+                M[known] = self.nrep
+                filled = int(known.sum())
+            rows, cols = np.nonzero(~known)
+            self.eval_points(frac_type, M, known, rows, cols, batch)
+            rects = np.zeros((0, 4), dtype=np.intp)
+        else:
+            rects = np.array([[0, h-1, 0, w-1]])
+        while len(rects):
+            r0, r1, c0, c1 = rects.T
+            # Border pixels of every rectangle, tagged with the rectangle they belong to
+            top, tc = ranges(c0, c1+1)
+            bottom, bc = ranges(c0, c1+1)
+            left, lr = ranges(r0+1, r1)
+            right, rr = ranges(r0+1, r1)
+            ids = np.concatenate([top, bottom, left, right])
+            rows = np.concatenate([r0[top], r1[bottom], lr, rr])
+            cols = np.concatenate([tc, bc, c0[left], c1[right]])
+            self.eval_points(frac_type, M, known, rows, cols, batch)
+            values = M[rows, cols]
+            lo, hi = np.full(len(rects), values.max()), np.full(len(rects), values.min())
+            np.minimum.at(lo, ids, values)
+            np.maximum.at(hi, ids, values)
+
+            inside = (r1-r0 >= 2) & (c1-c0 >= 2)
+            uniform = inside & (lo == hi)
+            for (a, b, c, d), v in zip(rects[uniform], lo[uniform]):
+                M[a+1:b, c+1:d] = v
+                known[a+1:b, c+1:d] = True
+            filled += int(((r1-r0-1)*(c1-c0-1))[uniform].sum())
+            small = inside & ~uniform & ((r1-r0 <= min_size) | (c1-c0 <= min_size))
+            if small.any():
+                a, b, c, d = rects[small].T
+                row_ids, rows = ranges(a+1, b)
+                col_ids, cols = ranges(c[row_ids]+1, d[row_ids])
+                self.eval_points(frac_type, M, known, rows[col_ids], cols, batch)
+            a, b, c, d = rects[inside & ~uniform & ~small].T
+            rm, cm = (a+b)//2, (c+d)//2
+            rects = np.concatenate([np.stack(q, axis=1) for q in
+                                    ((a, rm, c, cm), (a, rm, cm, d), (rm, b, c, cm), (rm, b, cm, d))])
+
+        self.stats = dict(kernel_stats, filled=filled)
+        if self.debug:
+            print('Plane generation (subdivided):{:0.3f}s, {:0.1%} filled'.format(time()-start_exec, filled/(h*w)))
+            print('Resolved points:', ', '.join('{}={}'.format(k, v) for k, v in sorted(self.stats.items())))
+
+    def eval_points(self, frac_type, M, known, rows, cols, batch=2**16):
+        # Evaluate the pixels M[rows, cols] not known yet, in batches of points
+        h, w = M.shape
+        todo = np.zeros(h*w, dtype=bool)
+        todo[rows*w+cols] = True
+        rows, cols = np.nonzero(todo.reshape(h, w) & ~known)
+        dtype = self.plane_dtype(frac_type)
+        X, Y = [a.astype(dtype) for a in self.get_axes()]
+        bk = self.backend
+        for lo in range(0, len(rows), batch):
+            self.check()
+            r, c = rows[lo:lo+batch], cols[lo:lo+batch]
+            M[r, c] = bk.numpy(frac_type(bk.asarray(X[c]+Y[r]), self.nrep))
+        known[rows, cols] = True
+
+    def gen_cached(self, frac_type, cache, backend=None):
+        # Assemble the frame from square tiles of a pyramid: a level is a pixel spacing,
+        # halved on every 2x zoom, and pixel (ix, iy) of a level sits at (ix*dx, iy*dy).
+        # The view is snapped to that lattice and only the tiles missing from the
+        # cache are rendered
+        self.select(backend)
+        start_exec = time()
+        kernel_stats.clear()
+        hits, misses = cache.hits, cache.misses
+        dx, dy = self.spacing()
+        ix0 = int(round((float(self.point[0])-self.wh[0])/dx))
+        iy0 = int(round((float(self.point[1])-self.wh[1])/dy))
+        self.point[0] = ix0*dx+self.wh[0]
+        self.point[1] = iy0*dy+self.wh[1]
+        h, w = self.M.shape
+        T = cache.tile
+        kind = kernel_key(frac_type, self.nrep)
+        for ty in range(iy0//T, (iy0+h-1)//T+1):
+            for tx in range(ix0//T, (ix0+w-1)//T+1):
+                self.check()
+                key = (kind, dx, dy, tx, ty)
+                tile = cache.get(key)
+                if tile is None:
+                    tile = self.eval_tile(frac_type, tx, ty, T, dx, dy)
+                    cache.put(key, tile)
+                # Overlap of the tile with the view, in view and in tile pixels
+                x0, x1 = max(tx*T, ix0), min((tx+1)*T, ix0+w)
+                y0, y1 = max(ty*T, iy0), min((ty+1)*T, iy0+h)
+                self.M[y0-iy0:y1-iy0, x0-ix0:x1-ix0] = tile[y0-ty*T:y1-ty*T, x0-tx*T:x1-tx*T]
+
+        self.stats = dict(kernel_stats, tile_hits=cache.hits-hits, tile_misses=cache.misses-misses)
+        if self.debug:
+            print('Plane generation (cached):{:0.3f}s'.format(time()-start_exec))
+            print('Tiles: {} hits, {} misses, hit rate {:0.2f}'.format(
+                self.stats['tile_hits'], self.stats['tile_misses'], cache.hit_rate()))
+
+    def eval_tile(self, frac_type, tx, ty, T, dx, dy):
+        bk = self.backend
+        X = bk.asarray(((tx*T+np.arange(T))*dx).astype(np.complex128))
+        Y = bk.asarray((ty*T+np.arange(T))*dy*1j)
+        return bk.numpy(frac_type(bk.tile(X, Y, 0, T, True), self.nrep)).astype(self.M.dtype)
+
+    def gen_deep(self, frac_type, chunk_size=2, skip=False):
+        # One reference orbit in arbitrary precision, every pixel iterated as a
+        # float64 offset from it
+        if kernel_name(frac_type) != 'mandelbrot':
+            raise ValueError('Deep zoom is only available for mandelbrot')
+        start_exec = time()
+        kernel_stats.clear()
+        digits = precision(self.scale)
+        with stage('reference', digits=digits):
+            Z = reference_orbit(self.point, self.nrep, digits)
+        with stage('series'):
+            coefficients = series(Z) if skip else None
+        dX = np.linspace(-self.wh[0], self.wh[0], self.resolution[0]).astype(np.complex128)
+        dY = np.linspace(-self.wh[1], self.wh[1], self.resolution[1])*1j
+        bk = backends.get_backend('numpy')
+        n = self.resolution[1] if self.row_wise else self.resolution[0]
+        for lo in range(0, n, chunk_size):
+            self.check()
+            hi = min(lo+chunk_size, n)
+            with stage('perturb', lo=lo):
+                values = perturb(Z, bk.tile(dX, dY, lo, hi, self.row_wise), self.nrep, coefficients)
+            with stage('store', lo=lo):
+                store_tile(self.M, lo, hi, self.row_wise, values)
+            instrument.count(points=values.size)
+
+        self.stats = dict(kernel_stats)
+        instrument.count(**kernel_stats)
+        if self.debug:
+            print('Reference orbit: {} iterations at {} digits'.format(len(Z)-1, digits))
+            if skip:
+                points = self.resolution[0]*self.resolution[1]
+                print('Series approximation skipped {:0.1f} iterations per pixel'.format(
+                    self.stats.get('skipped', 0)/points))
+            print('Plane generation (deep):{:0.3f}s'.format(time()-start_exec))
+            print('Resolved points:', ', '.join('{}={}'.format(k, v) for k, v in sorted(self.stats.items())))
+
+    def auto_nrep(self, frac_type=None, probe=48, threshold=5e-3, limit=2**15-1, backend=None):
+        # Iteration cap for the view. The zoom depth gives the first guess, then a
+        # probe x probe grid of the view is rendered and the cap doubled while more
+        # than threshold of it is undecided (reached the cap without being proven
+        # interior) and the escape histogram has not died out below the cap, that
+        # is escapes still happen in the upper half of it or none happened yet
+        frac_type = frac_type or mandelbrot
+        start_exec = time()
+        nrep = int(min(limit, 100*max(1., -np.log10(self.scale))))
+        c = self.probe_grid(probe)
+        pending = np.ones(c.shape, dtype=bool)
+        escaped = 0
+        while True:
+            kernel_stats.clear()
+            counts = self.probe(frac_type, c[pending], nrep, backend)
+            undecided = kernel_stats['max_iter']/c.size
+            escaped += np.count_nonzero(counts < nrep)
+            tail = np.count_nonzero((counts >= nrep//2) & (counts < nrep))/c.size
+            if undecided < threshold or (escaped and tail < threshold) or nrep >= limit:
+                break
+            pending[pending] = counts >= nrep
+            nrep = min(limit, 2*nrep)
+        self.nrep = nrep
+        if self.debug:
+            print('Iteration cap {}, {:0.2%} undecided, probe {:0.3f}s'.format(nrep, undecided, time()-start_exec))
+        return nrep
+
+    def probe_grid(self, probe):
+        # probe x probe points spread over the view, as offsets from the center for
+        # deep views
+        if self.scale < deep_scale:
+            X = np.linspace(-self.wh[0], self.wh[0], probe)
+            Y = np.linspace(-self.wh[1], self.wh[1], probe)
+        else:
+            X, Y = self.get_axes()
+            X, Y = X[np.linspace(0, len(X)-1, probe).astype(int)], Y[np.linspace(0, len(Y)-1, probe).astype(int)]
+        return (Y.reshape(-1, 1)+X.reshape(1, -1)).astype(np.complex128)
+
+    def probe(self, frac_type, c, nrep, backend=None):
+        if deep_view(self.scale, frac_type):
+            return perturb(reference_orbit(self.point, nrep, precision(self.scale)), c, nrep)
+        bk = backend or self.select(None)
+        if kernel_name(frac_type) == 'mandelbrot':
+            return np.asarray(mandelbrot(bk.asarray(c), nrep, interior_check=True))
+        return np.asarray(frac_type(bk.asarray(c), nrep))
+
+    def resume(self, frac_type, chunk_size):
+        # Tiles already in the memmap file from an earlier run of the same render.
+        # The progress file next to it is a log: a JSON line naming the render, then
+        # one line per finished tile. A render of another job starts a new log
+        self.job = repr((str(self.point[0]), str(self.point[1]), self.scale, self.wh, self.nrep, chunk_size,
+                         self.row_wise, kernel_key(frac_type, self.nrep)))
+        self.pending = []
+        self.recorded = time()
+        try:
+            with open(self.path+'.progress') as f:
+                header = json.loads(f.readline())
+                # A line cut short by a crash is not a finished tile
+                done = [int(line) for line in f if line.endswith('\n')]
+        except (OSError, ValueError):
+            header, done = {}, []
+        if header.get('job') == self.job:
+            self.done = set(done)
+        else:
+            self.done = set()
+            with open(self.path+'.progress.tmp', 'w') as f:
+                f.write(json.dumps({'job': self.job})+'\n')
+            os.replace(self.path+'.progress.tmp', self.path+'.progress')
+        if self.debug and self.done:
+            print('Resuming {}, {} tiles done'.format(self.path, len(self.done)))
+        return self.done
+
+    def tile_done(self, lo):
+        # Tiles are recorded in batches, every record_tiles tiles or record_seconds,
+        # so flushing M and writing the log does not grow with the number of tiles
+        self.done.add(lo)
+        self.pending.append(lo)
+        if len(self.pending) >= self.record_tiles or time()-self.recorded >= self.record_seconds:
+            self.record()
+
+    def record(self):
+        # Flush M to disk before appending its tiles to the log, a crash loses at
+        # most the tiles of one batch
+        if self.pending:
+            self.M.flush()
+            with open(self.path+'.progress', 'a') as f:
+                f.write(''.join('{}\n'.format(lo) for lo in self.pending))
+        self.pending = []
+        self.recorded = time()
+
+    def tune_chunk(self, frac_type=None, backend=None, memory=256*2**20, rows=256):
+        # Rows per chunk giving the best throughput, timed on a band of rows around
+        # the middle of the view for chunk sizes of powers of 4, leaving out those
+        # whose points and kernel temporaries (about 80 bytes a point) would take
+        # more than memory. Kept per backend, resolution and dtype in the cache
+        # directory, so only the first render of a kind is timed
+        bk = self.select(backend)
+        frac_type = frac_type or mandelbrot
+        n, width = self.resolution[::-1] if self.row_wise else self.resolution
+        # Timed and kept for the C plane dtype gen will use
+        dtype = self.plane_dtype(frac_type)
+        key = '{} {}x{} {}'.format(bk.name, self.resolution[0], self.resolution[1], np.dtype(dtype).name)
+        path = os.path.join(backends.cache_dir, 'chunks.json')
+        try:
+            with open(path) as f:
+                tuned = json.load(f)
+        except (OSError, ValueError):
+            tuned = {}
+        if key in tuned:
+            return tuned[key]
+        limit = max(1, memory//(80*width))
+        rows = min(rows, n)
+        candidates = sorted({min(4**k, rows, limit) for k in range(8)})
+        X, Y = [bk.asarray(a.astype(dtype)) for a in self.get_axes()]
+        start = (n-rows)//2
+        frac_type(bk.tile(X, Y, start, start+1, self.row_wise), self.nrep)  # Warm up, JIT compilation
+        timings = {}
+        for size in candidates:
+            begin = time()
+            for lo in range(start, start+rows, size):
+                frac_type(bk.tile(X, Y, lo, min(lo+size, start+rows), self.row_wise), self.nrep)
+            timings[size] = time()-begin
+        best = min(timings, key=timings.get)
+        if self.debug:
+            print('Chunk size {} ({})'.format(best, ', '.join('{}: {:0.3f}s'.format(*t) for t in timings.items())))
+        tuned[key] = best
+        try:
+            os.makedirs(backends.cache_dir, exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(tuned, f, indent=1)
+        except OSError:
+            pass
+        return best
+
+    def tile_buffer(self, rows, width, dtype=np.complex128):
+        # Preallocated chunk of the C plane, reused while the shape does not change
+        if getattr(self, 'buf', None) is None or self.buf_key != (self.backend.name, rows, width, dtype):
+            self.buf = self.backend.empty((rows, width), dtype)
+            self.buf_key = (self.backend.name, rows, width, dtype)
+        return self.buf
+
+    def plane_dtype(self, frac_type=None):
+        # complex64 is used while a float32 coordinate is off by less than 1/1024 of
+        # a pixel anywhere in the view, its relative error being 2**-24. Decided once
+        # per view
+        if self.dtype != 'auto':
+            return np.dtype(self.dtype)
+        dx, dy = self.spacing()
+        extent = max(abs(float(self.point[0]))+self.wh[0], abs(float(self.point[1]))+self.wh[1])
+        key = (dx, dy, extent, self.nrep, self.validate, kernel_key(frac_type or mandelbrot, self.nrep))
+        if key not in self.planes:
+            dtype = np.dtype(np.complex64 if min(dx, dy) >= extent*2.**-14 else np.complex128)
+            # The coarse spacing rule does not see the iteration cap, orbits near the
+            # boundary drift further apart the longer they run, so it is always checked
+            samples = max(self.validate, int(np.ceil(10/self.tolerance)))
+            if dtype == np.complex64 and self.compare_precision(frac_type, samples) > self.tolerance:
+                dtype = np.dtype(np.complex128)
+            self.planes = {key: dtype}
+            if self.debug:
+                print('C plane in', dtype)
+        return self.planes[key]
+
+    def compare_precision(self, frac_type=None, samples=None):
+        # Fraction of samples (validate by default) random pixels whose count differs
+        # between complex64 and complex128
+        frac_type = frac_type or mandelbrot
+        bk = self.select(None)
+        X, Y = self.get_axes()
+        rng = np.random.default_rng(0)
+        i, j = rng.integers(0, len(X), samples or self.validate), rng.integers(0, len(Y), samples or self.validate)
+        counts = [bk.numpy(frac_type(bk.asarray(X.astype(dtype)[i]+Y.astype(dtype)[j]), self.nrep))
+                  for dtype in (np.complex128, np.complex64)]
+        mismatch = np.count_nonzero(counts[0] != counts[1])/len(i)
+        if self.debug:
+            print('Precision check: {:0.2%} of {} pixels differ in complex64'.format(mismatch, len(i)))
+        return mismatch
+
+    def share(self):
+        # Move M into a shared memory block so worker processes can write into it
+        shape = self.M.T.shape if self.row_wise else self.M.shape
+        if getattr(self, 'shm', None) is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=self.M.nbytes)
+            M = np.ndarray(shape, dtype=self.M.dtype, buffer=self.shm.buf)
+            M[:] = self.M.T if self.row_wise else self.M
+            self.M = M.T if self.row_wise else M
+        return self.shm.name, shape
+
+    def release(self):
+        # Copy M back to private memory and free the shared block
+        if getattr(self, 'shm', None) is None:
+            return
+        self.M = self.M.copy(order='K')
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+    def __del__(self):
+        shm = getattr(self, 'shm', None)
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    def gen_parallel(self, frac_type, chunk_size=2, workers=None):
+        # Split the plane in tiles of chunk_size rows (columns) and render them in a
+        # pool of processes, each one writing its tile straight into the shared M
+        workers = os.cpu_count() if workers is None else workers
+        n = self.resolution[1] if self.row_wise else self.resolution[0]
+        tiles = [(lo, min(lo+chunk_size, n)) for lo in range(0, n, chunk_size) if lo not in self.done]
+        # A memmap M is opened by every worker from its file, else M is shared memory
+        name, shape = (None, self.path) if self.path is not None else self.share()
+        start_exec = time()
+        kernel_stats.clear()
+        dtype = self.plane_dtype(frac_type)
+        init_args = (name, shape, self.M.dtype, self.row_wise, [a.astype(dtype) for a in self.get_axes()],
+                     frac_type, self.nrep, self.backend.name)
+        mp = backends.process_context()
+        # Leaving the with block terminates the workers, also on an error or a
+        # cancel. M is then copied out of the shared block, which is freed, so the
+        # result does not depend on the block staying mapped
+        try:
+            with mp.Pool(workers, initializer=_init_worker, initargs=init_args) as pool:
+                for lo, stats in pool.imap_unordered(_render_tile, tiles):
+                    kernel_stats.update(stats)
+                    instrument.count(**stats)
+                    if self.path is not None:
+                        self.tile_done(lo)
+                    self.check()
+                pool.close()
+                pool.join()
+        finally:
+            self.release()
+            if self.path is not None:
+                self.record()
+
+        self.stats = dict(kernel_stats)
+        if self.debug:
+            print('Plane generation ({} workers, {} tiles):{:0.3f}s'.format(workers, len(tiles), time()-start_exec))
+
+
+# State of a render worker process, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(name, shape, dtype, row_wise, axes, frac_type, nrep, backend):
+    bk = backends.use(backend)
+    bk.single_thread()
+    if name is None:
+        # shape is the path of a memmap M, stored in the orientation of M
+        _worker.update(M=np.load(shape, mmap_mode='r+'))
+    else:
+        shm = shared_memory.SharedMemory(name=name)
+        M = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        _worker.update(shm=shm, M=M.T if row_wise else M)
+    _worker.update(row_wise=row_wise, axes=[bk.asarray(a) for a in axes], frac_type=frac_type, nrep=nrep)
+
+
+def _render_tile(tile):
+    lo, hi = tile
+    X, Y = _worker['axes']
+    kernel_stats.clear()
+    points = backends.active.tile(X, Y, lo, hi, _worker['row_wise'])
+    # A memmap M is flushed by the parent before it records the tile
+    store_tile(_worker['M'], lo, hi, _worker['row_wise'], _worker['frac_type'](points, _worker['nrep']))
+    return lo, dict(kernel_stats)
+
+
+def open_mmap(path, shape, dtype=np.uint16):
+    # .npy file mapped in memory, reopened when it already holds an M of this shape
+    if os.path.exists(path):
+        M = np.load(path, mmap_mode='r+')
+        if M.shape == shape and M.dtype == dtype:
+            return M
+        del M
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+
+def coincident(old, new, tol=1e-6):
+    # Indices of the points of the new axis that fall on a point of the old one,
+    # within tol of a pixel, as (old indices, new indices)
+    step = (old[-1]-old[0])/(len(old)-1)
+    k = (new-old[0])/step
+    idx = np.rint(k)
+    hit = (np.abs(k-idx) < tol) & (idx >= 0) & (idx < len(old))
+    return idx[hit].astype(np.intp), np.nonzero(hit)[0]
+
+
+def ranges(starts, stops):
+    # Concatenated np.arange(start, stop) of every pair, with the index of the pair
+    # each value comes from
+    lengths = np.maximum(stops-starts, 0)
+    ids = np.repeat(np.arange(len(lengths)), lengths)
+    offsets = np.arange(lengths.sum())-np.repeat(np.cumsum(lengths)-lengths, lengths)
+    return ids, np.repeat(starts, lengths)+offsets
+
+
+def store_tile(M, lo, hi, row_wise, values):
+    if row_wise:
+        M[lo:hi] = values
+    else:
+        M[:, lo:hi] = values.T
 
 
 class Server(Fractal):
@@ -99,31 +744,48 @@ class Server(Fractal):
         self.color_map = None
         plt.rcParams['figure.figsize'] = [10, 10]
 
-    def run(self, frac_type, chunk_size=2, intpol='bilinear'):
-        self.gen(frac_type, chunk_size)
+    def run(self, frac_type, chunk_size=2, intpol='bilinear', **kwargs):
+        self.gen(frac_type, chunk_size, **kwargs)
         cm = 'hsv' if self.color_map is None else self.color_map
         plt.axis('off')
         plt.imshow(self.M, cmap=cm, interpolation=intpol)
 
-    def export(self, name):
-        np.savez_compressed(name, self.M)
+    def export(self, name, chunked=False, tile=256, workers=1):
+        # chunked writes a Store directory of compressed tiles and downsampled levels
+        # instead of one .npz, viewers then read only the tiles they show
+        if not chunked:
+            return np.savez_compressed(name, self.M)
+        store = Store.create(name, self.M.shape, self.M.dtype, tile, point=[str(p) for p in self.point],
+                             scale=self.scale, wh=self.wh, nrep=self.nrep, row_wise=self.row_wise)
+        store.write(self.M, workers)
+        return store
 
-    def save(self, name):
+    def save(self, name, fmt='png', band=256):
+        # Colored through a uint8 lookup table of the color map, one band of rows at
+        # a time streamed into the encoder, no float RGBA copy of M is made. Only PNG
+        # keeps to a band of memory, JPEG assembles the whole image
         cm = plt.cm.hsv if self.color_map is None else self.color_map
-        norm = plt.Normalize(vmin=self.M.min(), vmax=self.M.max())
-
-        # map the normalized data to colors
-        # image is now RGBA (512x512x4)
-        image = cm(norm(self.M))
-
-        # save the image
-        plt.imsave(name+'.jpg', image, dpi=1000)
-
+        bands = colorize(self.M, cm, band)
+        if fmt == 'png':
+            write_png(name+'.png', self.M.shape, bands)
+        else:
+            write_jpeg(name+'.'+fmt, self.M.shape, bands)
 
 
 class Explorer(Fractal):
-    def __init__(self, *args, **kwargs):
-        super(Explorer, self).__init__(*args, **kwargs)
+    def __init__(self, resolution, *args, cache=None, prefetch=0.5, **kwargs):
+        # An odd number of pixels on each axis puts a sample on the zoom centre, so
+        # after a zoom in or out every other sample lines up with the last frame and
+        # gen_reuse can use them. Even sizes are rounded up
+        resolution = [n+1-n % 2 for n in resolution]
+        super(Explorer, self).__init__(resolution, *args, **kwargs)
+        # The first frame has the extent the zoom keys give, or its x axis would
+        # not line up with the next zoom
+        self.wh = [1.25*self.scale, 1*self.scale]
+        # With a TileCache every frame is assembled from cached tiles when possible
+        self.cache = cache
+        # Fraction of the idle time spent rendering the views one key away, 0 disables
+        self.prefetch = prefetch
         self.fig, self.ax = plt.subplots()
         self.mv = 4
         self.point_text = plt.text(0.02, .9, str('Point: '+str(self.point)), fontsize=14, transform=plt.gcf().transFigure)
@@ -135,21 +797,37 @@ class Explorer(Fractal):
         self.scale_text.remove()
         self.scale_text=plt.text(0.02, .8, str('Scale: '+str(self.scale)), fontsize=14, transform=plt.gcf().transFigure)
 
+    def pan_step(self, frac=None):
+        # Pixels moved by an arrow key, pans snap to whole pixels so the frame can be
+        # shifted instead of recomputed
+        frac = frac or self
+        dx, dy = frac.spacing()
+        return max(1, round(frac.scale/self.mv/dx)), max(1, round(frac.scale/self.mv/dy))
+
     def event_update(self, event):
+        kx, ky = self.pan_step()
         if event.key == 'left':
-            self.point[0] -= self.scale/self.mv
+            self.move(-kx, 0)
         elif event.key == 'right':
-            self.point[0] += self.scale/self.mv
+            self.move(kx, 0)
         elif event.key == 'up':
-            self.point[1] -= self.scale/self.mv
+            self.move(0, -ky)
         elif event.key == 'down':
-            self.point[1] += self.scale/self.mv
+            self.move(0, ky)
         elif event.key == 'z':
+            self.previous = self.get_axes(), self.nrep
             self.scale /= 2
             self.wh = [1.25*self.scale, 1*self.scale]
+            self.moved = (0, 0)
+            if self.adaptive and getattr(self, 'worker', None) is None:
+                self.auto_nrep()
         elif event.key == 'x':
+            self.previous = self.get_axes(), self.nrep
             self.scale *= 2
             self.wh = [1.25*self.scale, 1*self.scale]
+            self.moved = (0, 0)
+            if self.adaptive and getattr(self, 'worker', None) is None:
+                self.auto_nrep()
         elif event.key == 'c':
             self.copy()
         elif event.key == 'escape':
@@ -158,56 +836,304 @@ class Explorer(Fractal):
 
         return 1
 
+    def start(self, frac_type=None, chunk_size='auto'):
+        # Render in a background thread: key events only move the target view and
+        # cancel the render in progress at its next chunk, the window shows the most
+        # recent finished frame (or pass of a progressive render)
+        self.renderer = Fractal(self.resolution, list(self.point), self.scale, self.nrep, self.row_wise, self.debug)
+        self.renderer.backend = self.backend
+        self.renderer.cancel = threading.Event()
+        if chunk_size == 'auto':
+            chunk_size = self.renderer.tune_chunk(frac_type)
+        self.valid = False  # The renderer M matches its view
+        self.probed = None  # Scale the iteration cap was last probed at, with nrep='auto'
+        # Views one key away rendered while idle, six frames of the current view
+        self.scratch = Fractal(self.resolution, list(self.point), self.scale, self.nrep, self.row_wise)
+        self.scratch.backend = self.backend
+        self.scratch.cancel = self.renderer.cancel
+        self.prefetched = TileCache(12*self.M.nbytes)
+        self.warmed = set()  # Views already rendered into the tile cache
+        self.prefetch_stats = {'rendered': 0, 'used': 0}
+        self.frame = None
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.running = True
+        self.worker = threading.Thread(target=self.render_loop, args=(frac_type or mandelbrot, chunk_size),
+                                       daemon=True)
+        self.worker.start()
+        self.timer = self.fig.canvas.new_timer(interval=30)
+        self.timer.add_callback(self.poll)
+        self.timer.start()
+        self.request()
+
+    def stop(self):
+        self.running = False
+        self.request()
+        self.timer.stop()
+
+    def request(self):
+        # Ask for the current view, abandoning whatever is being rendered
+        with self.lock:
+            self.renderer.cancel.set()
+            self.wake.set()
+
+    def render_loop(self, frac_type, chunk_size):
+        while True:
+            self.wake.wait()
+            with self.lock:
+                if not self.running:
+                    return
+                self.wake.clear()
+                self.renderer.cancel.clear()
+                target = list(self.point), self.scale, list(self.wh), self.nrep
+            if self.adaptive and target[1] != self.probed:
+                # The cap of a new scale is probed here rather than in the key
+                # callback, kernel_stats is only used from this thread meanwhile
+                s = self.scratch
+                s.change(target[0], target[1])
+                s.wh = target[2]
+                nrep = s.auto_nrep(frac_type)
+                self.probed = target[1]
+                with self.lock:
+                    self.nrep = nrep
+                target = target[:3]+(nrep,)
+            try:
+                self.render(frac_type, chunk_size, *target)
+            except Cancelled:
+                self.valid = False
+                continue
+            if self.prefetch > 0:
+                self.speculate(frac_type, chunk_size)
+
+    def view_key(self, point, scale, wh, nrep):
+        return (float(point[0]), float(point[1]), scale, tuple(wh), nrep)
+
+    def render(self, frac_type, chunk_size, point, scale, wh, nrep):
+        # Bring the renderer to the target view doing as little work as possible:
+        # a prefetched frame, shift after a pan, reuse coincident samples after a
+        # zoom, else progressive. Deep views are always rendered in full by gen
+        r = self.renderer
+        if self.prefetch > 0:
+            M = self.prefetched.get(self.view_key(point, scale, wh, nrep))
+            if M is not None:
+                self.prefetch_stats['used'] += 1
+                r.change(point, scale, nrep)
+                r.wh = wh
+                r.M[:] = M
+                self.valid = True
+                return self.publish(1)
+        if self.cache is not None or deep_view(scale, frac_type):
+            self.valid = False
+            r.change(point, scale, nrep)
+            r.wh = wh
+            r.gen(frac_type, chunk_size, cache=self.cache)
+            self.valid = True
+            return self.publish(1)
+        if self.valid and r.nrep == nrep and r.wh == wh:
+            dx, dy = r.spacing()
+            di, dj = (point[0]-r.point[0])/dx, (point[1]-r.point[1])/dy
+            if abs(di-round(di)) < 1e-6 and abs(dj-round(dj)) < 1e-6:
+                self.valid = False
+                r.move(int(round(di)), int(round(dj)))
+                r.point = point
+                r.gen_moved(frac_type, chunk_size)
+                self.valid = True
+                return self.publish(1)
+        previous = r.get_axes() if self.valid and r.nrep == nrep else None
+        self.valid = False
+        r.change(point, scale, nrep)
+        r.wh = wh
+        if previous is not None and r.gen_reuse(frac_type, previous, chunk_size):
+            self.valid = True
+            return self.publish(1)
+        for step in r.gen_progressive(frac_type, chunk_size):
+            self.publish(step)
+        self.valid = True
+
+    def neighbours(self):
+        # Views of the renderer one key away: the four pans and both zooms, with the
+        # extent event_update gives them
+        r = self.renderer
+        dx, dy = r.spacing()
+        kx, ky = self.pan_step(r)
+        for di, dj in ((-kx, 0), (kx, 0), (0, -ky), (0, ky)):
+            yield 'pan', (di, dj), [r.point[0]+di*dx, r.point[1]+dj*dy], r.scale, list(r.wh)
+        for scale in (r.scale/2, r.scale*2):
+            yield 'zoom', None, list(r.point), scale, [1.25*scale, scale]
+
+    def speculate(self, frac_type, chunk_size):
+        # Render the neighbouring views into the prefetch cache while no key comes
+        # in, resting between views to keep to the prefetch share of the idle time.
+        # A key press cancels the view being rendered. With a tile cache the views
+        # only warm it: gen_cached snaps the view to its lattice, so whole frames
+        # would be kept under a view no key asks for
+        r, s = self.renderer, self.scratch
+        for kind, shift, point, scale, wh in self.neighbours():
+            key = self.view_key(point, scale, wh, r.nrep)
+            if key in self.prefetched or key in self.warmed:
+                continue
+            start = time()
+            try:
+                if self.cache is not None:
+                    s.change(point, scale, r.nrep)
+                    s.wh = wh
+                    self.cache.speculative = True
+                    try:
+                        s.gen(frac_type, chunk_size, cache=self.cache)
+                    finally:
+                        self.cache.speculative = False
+                    self.warmed.add(key)
+                elif deep_view(scale, frac_type):
+                    s.change(point, scale, r.nrep)
+                    s.wh = wh
+                    s.gen(frac_type, chunk_size, cache=self.cache)
+                elif kind == 'pan':
+                    # The scratch starts from the renderer frame, it still holds the
+                    # last view speculated
+                    s.change(list(r.point), r.scale, r.nrep)
+                    s.wh = list(r.wh)
+                    s.M[:] = r.M
+                    s.move(*shift)
+                    s.point = point
+                    s.gen_moved(frac_type, chunk_size)
+                else:
+                    s.change(point, scale, r.nrep)
+                    s.wh = wh
+                    s.M[:] = r.M
+                    if not s.gen_reuse(frac_type, r.get_axes(), chunk_size):
+                        s.gen(frac_type, chunk_size)
+            except Cancelled:
+                return
+            if self.cache is None:
+                self.prefetched.put(key, s.M.copy())
+            self.prefetch_stats['rendered'] += 1
+            if self.wake.wait((time()-start)*(1-self.prefetch)/self.prefetch):
+                return
+
+    def prefetch_report(self):
+        # How often a key found its view already rendered, with a tile cache how many
+        # tiles rendered ahead were used
+        report = dict(self.prefetch_stats)
+        report['hits'], report['misses'] = self.prefetched.hits, self.prefetched.misses
+        report['hit_rate'] = self.prefetched.hit_rate()
+        if self.cache is not None:
+            report['tile_hits'] = self.cache.prefetch_hits
+            report['tiles_rendered'] = self.cache.prefetch_hits+len(self.cache.prefetched)
+        return report
+
+    def publish(self, step):
+        with self.lock:
+            self.frame = self.renderer.M.copy(), step
+
+    def poll(self):
+        # Timer callback on the GUI thread, draws the last published frame
+        with self.lock:
+            frame, self.frame = self.frame, None
+        if frame is not None:
+            self.M, step = frame
+            self.show(step)
+
     def gen_cm(self, hex_list, range_list):
         if len(hex_list) != len(range_list):
             return -1
         colors = [hex2rgb(h) for h in hex_list]
 
-    def show(self):
-        self.ax.imshow(self.M, interpolation='nearest')
+    def show(self, step=1):
+        # With step > 1 only M[::step, ::step] is rendered, each sample fills its block
+        img = self.M
+        if step > 1:
+            img = np.repeat(np.repeat(img[::step, ::step], step, 0), step, 1)[:img.shape[0], :img.shape[1]]
+        if getattr(self, 'image', None) is None:
+            self.image = self.ax.imshow(img, interpolation='nearest')
+        else:
+            self.image.set_data(img)
+            self.image.set_clim(img.min(), img.max())
         plt.draw()
+        if step > 1:
+            # Paint now, the callback is still running the next passes
+            self.fig.canvas.draw()
+            self.fig.canvas.flush_events()
 
     def copy(self):
         s = 'python gui.py --px {:0.5f} --py {:0.5f}'' --s {}'.format(self.point[0], self.point[1], self.scale)
         os.system('echo {} |xclip -selection c'.format(s))
 
 
-def mandelbrot(c, nrep):
+def escape_time(z, c, nrep, compact=False, periodic=False):
+    # Number of iterations z -> z**2+c stays inside |z| < 2, on the backend of z
+    return backend_for(z).escape_time(z, c, nrep, compact, periodic)
 
-    z = c.clone().zero_()
 
-    M = torch.zeros(z.shape, dtype=torch.int16, device=ctx)
-    for _ in range(nrep):
-        z = z**2+c
-        if all(z.abs() >= 2):
-            break
-        M += z.abs() < 2
+def mandelbrot(c, nrep, compact=False, interior_check=False):
+    return backend_for(c).mandelbrot(c, nrep, compact, interior_check)
 
-    if ctx.type == 'cuda':
-        return M.cpu()
-    else:
-        return M
 
+def kernel_name(frac_type):
+    # Name of the kernel behind a frac_type, also through functools.partial
+    return getattr(getattr(frac_type, 'func', frac_type), '__name__', None)
 
-def julia(c):
-    def constrained_julia(z, nrep):
-        M = torch.zeros(z.shape, dtype=torch.int16, device=ctx)
-        for _ in range(nrep):
-            z = z**2+c
-            if all(z.abs() >= 2):
-                break
-            M += z.abs() < 2
 
-        if ctx.type == 'cuda':
-            return M.cpu()
-        else:
-            return M
-    return constrained_julia
+def deep_view(scale, frac_type):
+    # Views gen renders with the perturbation engine, the frame shifting and sample
+    # reuse paths work on the complex128 grid and go through gen instead
+    return scale < deep_scale and kernel_name(frac_type) == 'mandelbrot'
+
+
+def constrained_julia(z, nrep, c, compact=False):
+    return escape_time(z, c, nrep, compact)
+
+
+def julia(c, compact=False):
+    # A partial instead of a closure so it can be sent to worker processes
+    return partial(constrained_julia, c=c, compact=compact)
+
+
+def formula_type(c, nrep, formula, julia=None):
+    if julia is None:
+        return formula_escape_time(formula, backend_for(c).zeros(c), c, nrep)
+    return formula_escape_time(formula, c, julia, nrep)
 
-def event_handler(event, frac):
+
+def fractal(formula, julia=None):
+    # Kernel of an escape-time formula (see formula.Formula, a name of formula.formulas
+    # or multibrot<d>), compiled for the backend on first use. With julia, every
+    # point is the starting z and julia the constant c
+    return partial(formula_type, formula=parse_formula(formula), julia=julia)
+
+
+def multibrot(d, julia=None):
+    return fractal(multibrot_formula(d), julia)
+
+
+burning_ship = fractal('burning_ship')
+tricorn = fractal('tricorn')
+
+def event_handler(event, frac, frac_type=mandelbrot):
+    if getattr(frac, 'worker', None) is not None:
+        # Background rendering, only the target view changes here
+        if frac.event_update(event):
+            frac.request()
+        else:
+            frac.stop()
+            plt.close()
+        return
     if frac.event_update(event):
-        frac.gen(mandelbrot, chunk_size=500)
-        frac.show()
+        if frac.cache is not None or deep_view(frac.scale, frac_type):
+            frac.moved, frac.previous = (0, 0), None
+            frac.gen(frac_type, chunk_size=500, cache=frac.cache)
+            frac.show()
+            return
+        if frac.moved != (0, 0):
+            frac.gen_moved(frac_type, chunk_size=500)
+            frac.show()
+            return
+        # Samples of the last frame are only reused under the same iteration cap
+        previous, frac.previous = frac.previous, None
+        if previous is not None and previous[1] == frac.nrep and frac.gen_reuse(frac_type, previous[0], chunk_size=500):
+            frac.show()
+            return
+        for step in frac.gen_progressive(frac_type, chunk_size=500):
+            frac.show(step)
     else:
         plt.close()
 
@@ -0,0 +1,100 @@
+import math
+from decimal import Decimal, localcontext
+
+import numpy as np
+
+from backends import kernel_stats
+
+# Below this scale the complex128 grid can no longer tell neighbouring pixels apart
+deep_scale = 1e-13
+
+
+def precision(scale):
+    # Decimal digits needed to place the reference point at this scale
+    return max(30, int(-math.log10(scale))+30)
+
+
+def reference_orbit(center, nrep, digits):
+    # Orbit of the center point computed with Decimal arithmetic and rounded to
+    # complex128, every other pixel is iterated as a small offset against it
+    with localcontext() as ctx:
+        ctx.prec = digits
+        cr, ci = Decimal(str(center[0])), Decimal(str(center[1]))
+        zr = zi = Decimal(0)
+        Z = np.zeros(nrep+1, dtype=np.complex128)
+        for n in range(nrep):
+            zr, zi = zr*zr-zi*zi+cr, 2*zr*zi+ci
+            Z[n+1] = complex(float(zr), float(zi))
+            if abs(Z[n+1]) >= 2:
+                return Z[:n+2]
+    return Z
+
+
+def series(Z):
+    # Coefficients of the offset as a cubic in the pixel offset along the reference,
+    #   d[n] ~ A[n]*dc + B[n]*dc**2 + C[n]*dc**3
+    A = np.zeros_like(Z)
+    B = np.zeros_like(Z)
+    C = np.zeros_like(Z)
+    with np.errstate(over='ignore', invalid='ignore'):
+        for n in range(Z.shape[0]-1):
+            A[n+1] = 2*Z[n]*A[n]+1
+            B[n+1] = 2*Z[n]*B[n]+A[n]**2
+            C[n+1] = 2*Z[n]*C[n]+2*A[n]*B[n]
+    return A, B, C
+
+
+def series_skip(Z, coefficients, radius, tol=1e-12):
+    # Last iteration the cubic still holds for every offset up to radius: the
+    # dropped terms stay below tol of the linear one and no pixel can escape yet
+    A, B, C = [np.abs(k) for k in coefficients]
+    with np.errstate(over='ignore', invalid='ignore'):
+        a, b, c = A*radius, B*radius**2, C*radius**3
+        ok = (c <= tol*a) & (np.abs(Z)+a+b+c < 2)
+    ok[0] = True
+    return int(np.logical_and.accumulate(ok).sum())-1
+
+
+def perturb(Z, dc, nrep, coefficients=None, tol=1e-12):
+    # Escape counts of the points Z[1]+dc, iterating only the offsets d = z-Z[m]:
+    #   d -> 2*Z[m]*d + d**2 + dc
+    # When |z| gets smaller than |d| the offset has lost its precision against the
+    # reference (a glitch) and the point is rebased, d = z and m back to 0. The
+    # same happens when a point outlives a reference that escaped before nrep.
+    # With the series coefficients every pixel starts straight at the last
+    # iteration the series approximation holds for the whole tile
+    shape = dc.shape
+    dc = dc.reshape(-1)
+    last = Z.shape[0]-1
+    M = np.full(dc.shape, nrep, dtype=np.int16)
+    idx = np.arange(dc.shape[0])
+    m = np.zeros(dc.shape, dtype=np.intp)
+    d = np.zeros_like(dc)
+    start = 0
+    if coefficients is not None:
+        start = min(series_skip(Z, coefficients, np.abs(dc).max(), tol), last-1, nrep)
+        A, B, C = [k[start] for k in coefficients]
+        d = ((C*dc+B)*dc+A)*dc
+        m[:] = start
+        kernel_stats['skipped'] += start*dc.shape[0]
+    for n in range(start, nrep):
+        if not idx.shape[0]:
+            break
+        kernel_stats['iterations'] += idx.shape[0]
+        d = (2*Z[m]+d)*d+dc
+        m += 1
+        z = Z[m]+d
+        zz = z.real**2+z.imag**2
+        out = zz >= 4
+        rebase = ~out & ((zz < d.real**2+d.imag**2) | (m == last))
+        if n+1 < nrep and rebase.any():
+            kernel_stats['rebased'] += int(rebase.sum())
+            d[rebase] = z[rebase]
+            m[rebase] = 0
+        if out.any():
+            M[idx[out]] = n
+            kernel_stats['escaped'] += int(out.sum())
+            keep = ~out
+            idx, m, d, dc = idx[keep], m[keep], d[keep], dc[keep]
+    kernel_stats['max_iter'] += idx.shape[0]
+    return M.reshape(shape)
@@ -1,21 +1,36 @@
-from core import Explorer, event_handler, mandelbrot
+from core import Explorer, TileCache, event_handler, fractal, mandelbrot
 import matplotlib.pyplot as plt
 import argparse
 
 parser = argparse.ArgumentParser('Mandelbrot fractal')
-parser.add_argument('--r', type=int, default=20, help='Resolution for height and width (squared)')
+parser.add_argument('--r', type=int, default=20, help='Resolution for height and width (squared), rounded up to odd')
 parser.add_argument('--px', type=float, default=-1, help='Initial center point on X')
 parser.add_argument('--py', type=float, default=0, help='Initial center point on Y')
 parser.add_argument('--s', type=float, default=0.5, help='Initial scale')
-parser.add_argument('--n', type=int, default=200, help='Number of repetitions')
+parser.add_argument('--n', type=lambda n: n if n == 'auto' else int(n), default=200,
+                    help='Number of repetitions, auto picks it from the zoom depth')
 parser.add_argument('--d', action='store_true', help='Flag to debug')
+parser.add_argument('--cache', type=int, default=0, help='Memory for the tile cache in MB, 0 disables it')
+parser.add_argument('--spill', type=str, default=None, help='Directory for tiles evicted from the cache')
+parser.add_argument('--prefetch', type=float, default=0.5,
+                    help='Share of the idle time spent rendering the next likely views, 0 disables it')
+parser.add_argument('--formula', type=str, default='mandelbrot',
+                    help='Fractal to explore: mandelbrot, burning_ship, tricorn or multibrot<d>')
+parser.add_argument('--sync', action='store_true', help='Render inside the key callback instead of in background')
 args = parser.parse_args()
 
+cache = TileCache(args.cache*2**20, args.spill) if args.cache else None
+frac = Explorer(resolution=[args.r]*2, point=[args.px, args.py], scale=args.s, nrep=args.n, debug=args.d, cache=cache,
+               prefetch=args.prefetch)
+frac_type = mandelbrot if args.formula == 'mandelbrot' else fractal(args.formula)
+cid = frac.fig.canvas.mpl_connect('key_press_event', lambda event: event_handler(event, frac, frac_type))
 
-frac = Explorer(resolution=[args.r]*2, point=[args.px, args.py], scale=args.s, nrep=args.n, debug=args.d, )
-cid = frac.fig.canvas.mpl_connect('key_press_event', lambda event: event_handler(event, frac))
 
-
-frac.gen(mandelbrot)
-frac.show()
-plt.show()
\ No newline at end of file
+if args.sync:
+    frac.gen(frac_type, cache=cache)
+    frac.show()
+else:
+    frac.start(frac_type)
+plt.show()
+if args.d and not args.sync:
+    print('Prefetch', frac.prefetch_report())
\ No newline at end of file
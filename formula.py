@@ -0,0 +1,330 @@
+import ast
+import hashlib
+import importlib.util
+import operator
+import os
+import sys
+from collections import namedtuple
+from math import comb
+
+import numpy as np
+
+from backends import backend_for, cache_dir, count_escaped, split
+
+
+class Formula(namedtuple('Formula', ['re', 'im', 'bailout'])):
+    # One step z -> f(z, c) of an escape-time fractal written on the real and
+    # imaginary parts: re and im give the next x and y from x, y (z) and a, b (c)
+    # with + - * / **, unary minus and abs. Points escape once x*x+y*y >= bailout
+    __slots__ = ()
+
+    def __new__(cls, re, im, bailout=4.):
+        return super(Formula, cls).__new__(cls, _parse(re), _parse(im), float(bailout))
+
+    @property
+    def digest(self):
+        return hashlib.sha1(repr(tuple(self)).encode()).hexdigest()[:16]
+
+
+names = {'x', 'y', 'a', 'b'}
+binary = {ast.Add: 'add', ast.Sub: 'sub', ast.Mult: 'mul', ast.Div: 'div', ast.Pow: 'pow'}
+folds = {'add': operator.add, 'sub': operator.sub, 'mul': operator.mul, 'div': operator.truediv, 'pow': operator.pow}
+
+
+def _parse(expr):
+    # Expression checked against the grammar above and written back in canonical
+    # form, so equal formulas share one digest and nothing else reaches exec
+    tree = ast.parse(expr.strip(), mode='eval')
+    _check(tree.body, expr)
+    return ast.unparse(tree)
+
+
+def _check(node, expr):
+    if isinstance(node, ast.BinOp) and type(node.op) in binary:
+        children = [node.left, node.right]
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+        children = [node.operand]
+    elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'abs' \
+            and len(node.args) == 1 and not node.keywords:
+        children = node.args
+    elif isinstance(node, ast.Name) and node.id in names or \
+            isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        children = []
+    else:
+        raise ValueError('{}: {} is not allowed in a formula'.format(expr, ast.unparse(node)))
+    for child in children:
+        _check(child, expr)
+
+
+def multibrot_formula(d):
+    # z**d+c expanded with the binomial theorem. For d=2 the terms are written as
+    # in the mandelbrot kernels, so the counts are the same
+    if int(d) != d or d < 2:
+        raise ValueError('multibrot needs an integer power of at least 2, got {}'.format(d))
+    d = int(d)
+    parts = ([], [])
+    for k in range(d+1):
+        # i**k is 1, i, -1, -i
+        coef = comb(d, k)*(-1)**(k//2)
+        term = '*'.join(['x']*(d-k)+['y']*k)
+        parts[k % 2].append(('-' if coef < 0 else '+')+(term if abs(coef) == 1 else '{}*{}'.format(abs(coef), term)))
+    return Formula(''.join(parts[0]).lstrip('+')+'+a', ''.join(parts[1]).lstrip('+')+'+b')
+
+
+formulas = {'mandelbrot': multibrot_formula(2),
+            'burning_ship': Formula('x*x-y*y+a', '2*abs(x*y)+b'),
+            'tricorn': Formula('x*x-y*y+a', '-2*x*y+b')}
+
+
+def parse_formula(spec):
+    # Formula of a spec: a Formula, a (re, im) or (re, im, bailout) tuple, a name
+    # of formulas or multibrot<d>
+    if isinstance(spec, Formula):
+        return spec
+    if isinstance(spec, (tuple, list)):
+        return Formula(*spec)
+    if spec in formulas:
+        return formulas[spec]
+    if spec.startswith('multibrot') and spec[len('multibrot'):].isdigit():
+        return multibrot_formula(int(spec[len('multibrot'):]))
+    raise ValueError('Unknown formula {}, options are {} or multibrot<d>'.format(spec, list(formulas)))
+
+
+# Array functions of the vectorized backends, all called with out=
+ops = {'numpy': {'add': 'np.add', 'sub': 'np.subtract', 'mul': 'np.multiply', 'div': 'np.divide',
+                 'pow': 'np.power', 'neg': 'np.negative', 'abs': 'np.absolute', 'lt': 'np.less',
+                 'and': 'np.logical_and',
+                 'copy': 'np.copyto({0}, {1})', 'fill': '{0}.fill({1})'},
+       'torch': {'add': 'torch.add', 'sub': 'torch.sub', 'mul': 'torch.mul', 'div': 'torch.div',
+                 'pow': 'torch.pow', 'neg': 'torch.neg', 'abs': 'torch.abs', 'lt': 'torch.lt',
+                 'and': 'torch.logical_and',
+                 'copy': '{0}.copy_({1})', 'fill': '{0}.fill_({1})'}}
+
+
+class _Vectorized(object):
+    # Turns the formula into a sequence of array operations writing into temporaries
+    # t0, t1, ..., so an iteration allocates nothing. A temporary is reused as soon
+    # as its value has been read, constants on the left of - / ** go to filled
+    # buffers k0, k1, ... since torch only takes a number on the right
+    def __init__(self, ops):
+        self.ops = ops
+        self.lines = []
+        self.free = []
+        self.temps = 0
+        self.constants = []
+
+    def temp(self):
+        if self.free:
+            return self.free.pop()
+        self.temps += 1
+        return 't{}'.format(self.temps-1)
+
+    def release(self, operand):
+        if isinstance(operand, str) and operand[0] == 't':
+            self.free.append(operand)
+
+    def emit(self, op, out, *args):
+        self.lines.append('{}({}, out={})'.format(self.ops[op], ', '.join(map(str, args)), out))
+
+    def target(self, *operands):
+        # Temporary the result goes to, the first temporary operand when there is one
+        temps = [o for o in operands if isinstance(o, str) and o[0] == 't']
+        for o in temps[1:]:
+            self.release(o)
+        return temps[0] if temps else self.temp()
+
+    def expr(self, node):
+        # Operand holding the value of node: a name, a temporary or a float
+        if isinstance(node, ast.Name):
+            return node.id
+        if isinstance(node, ast.Constant):
+            return float(node.value)
+        if isinstance(node, ast.UnaryOp):
+            value = self.expr(node.operand)
+            if isinstance(node.op, ast.UAdd):
+                return value
+            if isinstance(value, float):
+                return -value
+            out = self.target(value)
+            self.emit('neg', out, value)
+            return out
+        if isinstance(node, ast.Call):
+            value = self.expr(node.args[0])
+            if isinstance(value, float):
+                return abs(value)
+            out = self.target(value)
+            self.emit('abs', out, value)
+            return out
+        left, right = self.expr(node.left), self.expr(node.right)
+        op = binary[type(node.op)]
+        if isinstance(left, float) and isinstance(right, float):
+            return float(folds[op](left, right))
+        if isinstance(left, float):
+            if op in ('add', 'mul'):
+                left, right = right, left
+            else:
+                self.constants.append(left)
+                left = 'k{}'.format(len(self.constants)-1)
+        out = self.target(left, right)
+        self.emit(op, out, left, right)
+        return out
+
+    def value(self, expr):
+        # Temporary holding expr, copying names and filling constants into one
+        value = self.expr(ast.parse(expr, mode='eval').body)
+        if isinstance(value, str) and value[0] == 't':
+            return value
+        out = self.temp()
+        self.lines.append(self.ops['copy' if isinstance(value, str) else 'fill'].format(out, value))
+        return out
+
+    def source(self, formula):
+        # The new x and y are built in two temporaries that then swap places with x
+        # and y, the buffers rotate instead of being copied. alive stays False from
+        # the first escape on, an orbit coming back inside the bailout is not counted
+        # again, as in the numba loop
+        re = self.value(formula.re)
+        im = self.value(formula.im)
+        self.lines += ['x, {0} = {0}, x'.format(re), 'y, {0} = {0}, y'.format(im)]
+        self.release(re)
+        self.release(im)
+        r = self.value('x*x+y*y')
+        self.lines.append('{}({}, {!r}, out=inside)'.format(self.ops['lt'], r, formula.bailout))
+        self.emit('and', 'alive', 'alive', 'inside')
+        body = '\n'.join(' '*8+line for line in self.lines)
+        return '\n'.join(['def kernel(x, y, a, b, nrep, M, inside, alive, t, k):',
+                          '    '+self.ops['fill'].format('alive', True),
+                          '    {}, = t'.format(', '.join('t{}'.format(i) for i in range(self.temps))),
+                          '    {}, = k'.format(', '.join('k{}'.format(i) for i in range(len(self.constants))))
+                          if self.constants else '',
+                          '    for _ in range(nrep):',
+                          body,
+                          '        if not alive.any():',
+                          '            break',
+                          '        M += alive',
+                          '    return M', ''])
+
+
+class _Constants(ast.NodeTransformer):
+    # Numbers of the formula replaced by k0, k1, ... read from an array of the
+    # plane's dtype, so float32 planes are not promoted to float64 by numba
+    def __init__(self, constants):
+        self.constants = constants
+
+    def visit_Constant(self, node):
+        if float(node.value) not in self.constants:
+            self.constants.append(float(node.value))
+        return ast.Name('k{}'.format(self.constants.index(float(node.value))), ast.Load())
+
+
+numba_source = '''import numba
+import numpy as np
+
+
+@numba.njit(parallel=True, cache={cache})
+def loop(zr, zi, cr, ci, k, nrep, M):
+    {unpack} = k
+    for i in numba.prange(zr.shape[0]):
+        x, y = zr[i], zi[i]
+        a, b = cr[i], ci[i]
+        M[i] = nrep
+        for n in range(nrep):
+            x, y = {re}, {im}
+            if x*x+y*y >= bailout:
+                M[i] = n
+                break
+'''
+
+
+def _numba_kernel(formula):
+    # The loop is written to a file of the cache directory so numba can cache the
+    # machine code on disk too, and another process skips the compilation
+    constants = []
+    re, im = [ast.unparse(_Constants(constants).visit(ast.parse(e, mode='eval'))) for e in formula[:2]]
+    unpack = ', '.join(['k{}'.format(i) for i in range(len(constants))]+['bailout'])
+    source = numba_source.format(cache='{cache}', unpack=unpack, re=re, im=im)
+    path = os.path.join(cache_dir, 'kernels', 'formula_{}.py'.format(formula.digest))
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.exists(path):
+            with open(path+'.tmp', 'w') as f:
+                f.write(source.format(cache=True))
+            os.replace(path+'.tmp', path)
+        spec = importlib.util.spec_from_file_location('formula_{}'.format(formula.digest), path)
+        module = sys.modules[spec.name] = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        loop = module.loop
+    except OSError:
+        namespace = {}
+        exec(source.format(cache=False), namespace)
+        loop = namespace['loop']
+    return loop, constants+[formula.bailout]
+
+
+# Compiled kernels by backend and formula digest, each formula is compiled once
+# per process and backend
+_kernels = {}
+
+
+def compile_formula(formula, backend):
+    key = (backend.name, formula.digest)
+    if key not in _kernels:
+        if backend.name == 'numba':
+            _kernels[key] = _numba_kernel(formula)
+        else:
+            code = _Vectorized(ops[backend.name])
+            namespace = {'np': np}
+            if backend.name == 'torch':
+                namespace['torch'] = backend.torch
+            exec(code.source(formula), namespace)
+            _kernels[key] = namespace['kernel'], code.temps, code.constants
+    return _kernels[key]
+
+
+def formula_escape_time(formula, z, c, nrep):
+    # Number of iterations formula keeps z inside the bailout, for every point of z
+    bk = backend_for(z)
+    cr, ci = split(c)
+    if bk.name == 'numba':
+        loop, constants = compile_formula(formula, bk)
+        zr, zi = np.ascontiguousarray(z.real).reshape(-1), np.ascontiguousarray(z.imag).reshape(-1)
+        if np.ndim(cr) > 0:
+            cr, ci = np.ascontiguousarray(cr).reshape(-1), np.ascontiguousarray(ci).reshape(-1)
+        else:
+            cr, ci = np.full(zr.shape, cr, dtype=zr.dtype), np.full(zr.shape, ci, dtype=zr.dtype)
+        M = np.empty(zr.shape, dtype=np.int16)
+        loop(zr, zi, cr, ci, np.array(constants, dtype=zr.dtype), nrep, M)
+        M = M.reshape(z.shape)
+        count_escaped(M, nrep)
+        return M
+
+    kernel, temps, constants = compile_formula(formula, bk)
+    dtype = str(z.real.dtype).split('.')[-1]
+    x, y, a, b, *buffers = bk.workspace(z.shape, dtype, 4+temps+len(constants))
+    inside, alive = bk.workspace(z.shape, 'bool', 2)
+    # A single c (julia) is filled in too, torch takes no number as first operand
+    for buf, value in zip((x, y, a, b), (z.real, z.imag, cr, ci)):
+        _set(bk, buf, value)
+    for buf, value in zip(buffers[temps:], constants):
+        _set(bk, buf, value)
+    if bk.name == 'torch':
+        M = bk.torch.zeros(z.shape, dtype=bk.torch.int16, device=bk.ctx)
+        kernel(x, y, a, b, nrep, M, inside, alive, buffers[:temps], buffers[temps:])
+        count_escaped(M, nrep)
+        return M.cpu() if bk.ctx.type == 'cuda' else M
+    M = np.zeros(z.shape, dtype=np.int16)
+    with np.errstate(all='ignore'):  # Escaped points overflow
+        kernel(x, y, a, b, nrep, M, inside, alive, buffers[:temps], buffers[temps:])
+    count_escaped(M, nrep)
+    return M
+
+
+def _set(bk, buf, value):
+    if bk.name == 'torch' and np.ndim(value) == 0:
+        buf.fill_(value)
+    elif bk.name == 'torch':
+        buf.copy_(value)
+    elif np.ndim(value) == 0:
+        buf.fill(value)
+    else:
+        np.copyto(buf, value)
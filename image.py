@@ -0,0 +1,66 @@
+import struct
+import zlib
+
+import numpy as np
+
+
+def lut(cm, vmin, vmax):
+    # uint8 RGB color of every count between vmin and vmax, the same colors
+    # cm(Normalize(vmin, vmax)(M)) gives
+    counts = np.arange(vmin, vmax+1, dtype=np.float64)
+    return np.ascontiguousarray(cm((counts-vmin)/max(vmax-vmin, 1), bytes=True)[:, :3])
+
+
+def limits(M, band=256):
+    # Smallest and largest count of M, read band by band
+    lo, hi = np.iinfo(M.dtype).max, 0
+    for y in range(0, M.shape[0], band):
+        lo, hi = min(lo, int(M[y:y+band].min())), max(hi, int(M[y:y+band].max()))
+    return lo, hi
+
+
+def colorize(M, cm, band=256):
+    # RGB rows of M, one band at a time
+    vmin, vmax = limits(M, band)
+    colors = lut(cm, vmin, vmax)
+    for y in range(0, M.shape[0], band):
+        yield colors[np.asarray(M[y:y+band], dtype=np.intp)-vmin]
+
+
+def chunk(kind, data):
+    return struct.pack('>I', len(data))+kind+data+struct.pack('>I', zlib.crc32(kind+data) & 0xffffffff)
+
+
+def write_png(name, shape, bands, level=6):
+    # 8 bit RGB PNG written from bands of rows, each band is compressed and
+    # written before the next one is asked for
+    h, w = shape
+    deflate = zlib.compressobj(level)
+    with open(name, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 2, 0, 0, 0)))
+        for rgb in bands:
+            # Every row starts with its filter type, 0 for none
+            rows = np.zeros((rgb.shape[0], 1+3*w), dtype=np.uint8)
+            rows[:, 1:] = rgb.reshape(rgb.shape[0], -1)
+            data = deflate.compress(rows.tobytes())
+            if data:
+                f.write(chunk(b'IDAT', data))
+        f.write(chunk(b'IDAT', deflate.flush()))
+        f.write(chunk(b'IEND', b''))
+
+
+def write_jpeg(name, shape, bands, quality=95, limit=2**25):
+    # Pillow encodes JPEG from a whole image, which is assembled here as uint8 RGB:
+    # 3 bytes a pixel instead of the 32 of a float RGBA image. That is not bounded
+    # by a band, so images of more than limit pixels are refused, PNG streams them
+    if shape[0]*shape[1] > limit:
+        raise ValueError('{}x{} is too large for JPEG ({} pixels at most), save it as png'.format(
+            shape[1], shape[0], limit))
+    from PIL import Image
+    image = np.empty(tuple(shape)+(3,), dtype=np.uint8)
+    y = 0
+    for rgb in bands:
+        image[y:y+rgb.shape[0]] = rgb
+        y += rgb.shape[0]
+    Image.fromarray(image).save(name, quality=quality)
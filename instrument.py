@@ -0,0 +1,100 @@
+import json
+import os
+import threading
+from collections import Counter
+from time import perf_counter
+
+# Profiler the render stages report to, None while profiling is off. The hooks in
+# the render loops then cost one global lookup and an empty with block
+active = None
+
+
+class _Null(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+null = _Null()
+
+
+def stage(name, **args):
+    # with stage('kernel'): ... times the block as one event of the active profiler
+    if active is None:
+        return null
+    return _Stage(active, name, args)
+
+
+def count(**counters):
+    if active is not None:
+        active.counters.update(counters)
+
+
+def enable(profiler=None):
+    global active
+    active = profiler or Profiler()
+    return active
+
+
+def disable():
+    global active
+    profiler, active = active, None
+    return profiler
+
+
+class _Stage(object):
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.start, perf_counter()-self.start, self.args)
+        return False
+
+
+class Profiler(object):
+    # Events of every timed stage, total time and calls by stage and free counters
+    # (points, iterations, escaped, ...). Callbacks get every event as it ends
+    def __init__(self, keep_events=True):
+        self.keep_events = keep_events
+        self.events = []
+        self.totals = Counter()
+        self.calls = Counter()
+        self.counters = Counter()
+        self.callbacks = []
+        self.origin = perf_counter()
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def record(self, name, start, duration, args):
+        self.totals[name] += duration
+        self.calls[name] += 1
+        event = {'name': name, 'start': start-self.origin, 'duration': duration, 'pid': os.getpid(),
+                 'tid': threading.get_ident(), 'args': args}
+        if self.keep_events:
+            self.events.append(event)
+        for callback in self.callbacks:
+            callback(event)
+
+    def report(self):
+        return {'stages': {name: {'seconds': self.totals[name], 'calls': self.calls[name]} for name in self.totals},
+                'counters': dict(self.counters)}
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(dict(self.report(), events=self.events), f, indent=1)
+
+    def dump_chrome(self, path):
+        # Trace Event format, opens in chrome://tracing and Perfetto
+        events = [{'name': e['name'], 'ph': 'X', 'ts': e['start']*1e6, 'dur': e['duration']*1e6, 'pid': e['pid'],
+                   'tid': e['tid'], 'args': e['args']} for e in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'otherData': {'counters': dict(self.counters)}}, f)
@@ -3,6 +3,7 @@ import numpy as np
 from matplotlib.colors import ListedColormap, LinearSegmentedColormap
 from matplotlib import colormaps
 import matplotlib.pyplot as plt
+from store import load
 
 
 class Handler(object):
@@ -20,12 +21,9 @@ class Handler(object):
               'ytick.labelleft': 'off'}
     plt.rcParams.update (params)
 
-    def __init__(self, name):
-        with np.load(name) as f:
-            if len(f.files) == 1:
-                self.M = f[f.files[0]]
-            else:
-                self.M = [f[m] for m in f.files]
+    def __init__(self, name, size=2000):
+        # A chunked store is only read at the level that fits in size pixels
+        self.M = load(name, size)
         cm_name = name.split('.')[0]+'_cm'+'.npz'
         self.make_cm(cm_name)
 
@@ -1,11 +1,10 @@
 from core import Server, julia
 import matplotlib.pyplot as plt
-import torch
 
 if __name__ == "__main__":
 
     # frac = Server (resolution = [800, 1000], point = [-0.472, -0.19], scale = 0.02, debug = True, nrep = 500)
-    # frac_type = julia (torch.tensor (.285 + .01j, dtype = torch.complex128))
-    # frac.run (frac_type, chunk_size = 200)
+    # frac_type = julia (.285 + .01j)
+    # frac.run (frac_type, chunk_size = 200, backend = 'numba')
 
     plt.show()
@@ -0,0 +1,105 @@
+import json
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class Store(object):
+    # Render kept as a directory of independently compressed square tiles, so a
+    # region or a downsampled level is read without decompressing the rest.
+    # header.json holds the view, dtype, shape and tile size; level k holds every
+    # 2**k-th pixel of M in k/<ty>_<tx>.z files
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'header.json')) as f:
+            self.header = json.load(f)
+        self.shape = tuple(self.header['shape'])
+        self.dtype = np.dtype(self.header['dtype'])
+        self.tile = self.header['tile']
+        self.levels = self.header['levels']
+
+    @classmethod
+    def create(cls, path, shape, dtype, tile=256, levels=None, **view):
+        # Empty store for an M of this shape, levels defaults to halving down to one tile
+        if levels is None:
+            levels = 1
+            while max(shape) > tile*2**(levels-1):
+                levels += 1
+        header = dict(view, shape=list(shape), dtype=np.dtype(dtype).str, tile=tile, levels=levels)
+        for k in range(levels):
+            os.makedirs(os.path.join(path, str(k)), exist_ok=True)
+        with open(os.path.join(path, 'header.json'), 'w') as f:
+            json.dump(header, f, indent=1)
+        return cls(path)
+
+    def level_shape(self, k):
+        return tuple(-(-n//2**k) for n in self.shape)
+
+    def tiles(self, k):
+        h, w = self.level_shape(k)
+        return [(ty, tx) for ty in range(-(-h//self.tile)) for tx in range(-(-w//self.tile))]
+
+    def tile_path(self, k, ty, tx):
+        return os.path.join(self.path, str(k), '{}_{}.z'.format(ty, tx))
+
+    def write_tile(self, k, ty, tx, values):
+        with open(self.tile_path(k, ty, tx), 'wb') as f:
+            f.write(zlib.compress(np.ascontiguousarray(values, dtype=self.dtype).tobytes()))
+
+    def read_tile(self, k, ty, tx):
+        h, w = self.level_shape(k)
+        T = self.tile
+        shape = (min(T, h-ty*T), min(T, w-tx*T))
+        with open(self.tile_path(k, ty, tx), 'rb') as f:
+            return np.frombuffer(zlib.decompress(f.read()), dtype=self.dtype).reshape(shape)
+
+    def write(self, M, workers=1):
+        # Every level of M, tiles are compressed in a thread pool (zlib releases the
+        # GIL) and read from M one at a time, so a memmap M is streamed
+        T = self.tile
+
+        def write(job):
+            k, ty, tx = job
+            s = 2**k
+            self.write_tile(k, ty, tx, M[ty*T*s:(ty+1)*T*s:s, tx*T*s:(tx+1)*T*s:s])
+
+        jobs = [(k, ty, tx) for k in range(self.levels) for ty, tx in self.tiles(k)]
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(write, jobs))
+
+    def read(self, rows=None, cols=None, level=0):
+        # Region M[rows, cols] of a level, rows and cols are (start, stop) in pixels
+        # of that level, reading only the tiles it overlaps
+        h, w = self.level_shape(level)
+        y0, y1 = rows or (0, h)
+        x0, x1 = cols or (0, w)
+        T = self.tile
+        out = np.empty((y1-y0, x1-x0), dtype=self.dtype)
+        for ty in range(y0//T, -(-y1//T)):
+            for tx in range(x0//T, -(-x1//T)):
+                tile = self.read_tile(level, ty, tx)
+                a, b = max(ty*T, y0), min((ty+1)*T, y1)
+                c, d = max(tx*T, x0), min((tx+1)*T, x1)
+                out[a-y0:b-y0, c-x0:d-x0] = tile[a-ty*T:b-ty*T, c-tx*T:d-tx*T]
+        return out
+
+    def fit(self, size):
+        # First level with no side longer than size
+        for k in range(self.levels):
+            if max(self.level_shape(k)) <= size:
+                return k
+        return self.levels-1
+
+
+def load(name, size=None):
+    # M of a .npz export or of a store directory, a store is read at the first
+    # level that fits in size pixels
+    if os.path.isdir(name):
+        store = Store(name)
+        return store.read(level=0 if size is None else store.fit(size))
+    with np.load(name) as f:
+        if len(f.files) == 1:
+            return f[f.files[0]]
+        return [f[m] for m in f.files]